@@ -17,6 +17,67 @@ SQUEEZE_DRIP_HANDLER = getattr(settings, 'SQUEEZE_DRIP_HANDLER', 'squeezemail.ha
 # Be aware of your email server's send limits.
 SQUEEZE_CELERY_EMAIL_CHUNK_SIZE = getattr(settings, 'SQUEEZE_CELERY_EMAIL_CHUNK_SIZE', 100)
 
+# Before a broadcast is queued, an unsent SendDrip is bulk created for every subscriber, this many per INSERT.
+SQUEEZE_SENDDRIP_CREATE_CHUNK_SIZE = getattr(settings, 'SQUEEZE_SENDDRIP_CREATE_CHUNK_SIZE', 1000)
+
+# When queueing a broadcast's chunks, this many send_drip tasks are published through the same broker connection.
+SQUEEZE_CELERY_PUBLISH_BATCH_SIZE = getattr(settings, 'SQUEEZE_CELERY_PUBLISH_BATCH_SIZE', 50)
+
+# While sending a chunk, sent SendDrips (and subscriber step moves) are written back to the database in bulk every
+# this many emails, and once more at the end of the chunk.
+SQUEEZE_SEND_CHECKPOINT_SIZE = getattr(settings, 'SQUEEZE_SEND_CHECKPOINT_SIZE', 25)
+
+# A worker claims the SendDrips of the chunk it's sending for this many seconds, renewing the claim at every checkpoint.
+# If the worker dies, another one can claim (and send) what's left once the claim runs out.
+SQUEEZE_SEND_LEASE = getattr(settings, 'SQUEEZE_SEND_LEASE', 60 * 5)
+
+# Each celery worker process keeps its EMAIL_BACKEND connections open between chunks and tasks, up to this many per
+# relay (host/port/login). Keep (worker processes * this) under your relay's connection limit.
+SQUEEZE_SMTP_POOL_SIZE = getattr(settings, 'SQUEEZE_SMTP_POOL_SIZE', 1)
+
+# A pooled connection that's been idle for more than this many seconds is checked (SMTP NOOP) before it's reused.
+SQUEEZE_SMTP_CHECK_INTERVAL = getattr(settings, 'SQUEEZE_SMTP_CHECK_INTERVAL', 30)
+
+# Pooled connections older than this many seconds are closed and reopened. 0 keeps them until they fail.
+SQUEEZE_SMTP_MAX_AGE = getattr(settings, 'SQUEEZE_SMTP_MAX_AGE', 60 * 10)
+
+# send_drip renders this many emails ahead in a background thread and sends them to the backend as one batch, while
+# the next batch is rendered. 1 renders and sends one email at a time.
+SQUEEZE_SEND_WINDOW_SIZE = getattr(settings, 'SQUEEZE_SEND_WINDOW_SIZE', 1)
+
+# How send_drip talks to your mail server. 'sync' uses EMAIL_BACKEND. 'async' sends over many SMTP sessions at once
+# from each celery process (needs Python 3.5+ and pip install aiosmtplib), using the EMAIL_HOST/EMAIL_PORT/etc settings.
+SQUEEZE_SEND_ENGINE = getattr(settings, 'SQUEEZE_SEND_ENGINE', 'sync')
+
+# How many SMTP sessions each celery process keeps sending at once with the 'async' engine.
+SQUEEZE_ASYNC_SMTP_CONCURRENCY = getattr(settings, 'SQUEEZE_ASYNC_SMTP_CONCURRENCY', 10)
+
+# When send_drip renders ahead (SQUEEZE_SEND_WINDOW_SIZE over 1, or the 'async' engine), emails are rendered and
+# serialized by a pool of this many threads or processes. 0 renders them in the one background thread.
+# Try different sizes with: python manage.py benchmark_render <drip_id>
+SQUEEZE_RENDER_POOL_SIZE = getattr(settings, 'SQUEEZE_RENDER_POOL_SIZE', 0)
+
+# 'thread' or 'process'. Processes render in parallel for real, but can't be started from celery's default prefork
+# worker processes, only from workers started with --pool=solo/threads/gevent.
+SQUEEZE_RENDER_POOL = getattr(settings, 'SQUEEZE_RENDER_POOL', 'thread')
+
+# Build each drip email's bytes straight from a per drip MIME skeleton (see squeezemail.rendering.MimeSkeleton),
+# splicing in the subscriber's parts, instead of with Python's email package. Bodies are always sent
+# quoted-printable. Only used by message classes that have a raw_message, like DripMessage.
+SQUEEZE_PRESERIALIZE_MIME = getattr(settings, 'SQUEEZE_PRESERIALIZE_MIME', False)
+
+# The most emails a second all workers together send through a relay (EMAIL_HOST:EMAIL_PORT). Set it just under
+# your provider's limit. Workers share the count through your cache (it has to be one they all share, like memcached
+# or redis), and wait their turn instead of failing. None doesn't limit.
+SQUEEZE_SEND_RATE_LIMIT = getattr(settings, 'SQUEEZE_SEND_RATE_LIMIT', None)
+
+# Same as above, but per recipient domain, e.g. {'gmail.com': 20, 'yahoo.com': 10}.
+SQUEEZE_DOMAIN_RATE_LIMITS = getattr(settings, 'SQUEEZE_DOMAIN_RATE_LIMITS', {})
+
+# When the server says to slow down (421, 45x), every worker pauses sending through it for this many seconds, then
+# the email is tried once more.
+SQUEEZE_THROTTLE_BACKOFF = getattr(settings, 'SQUEEZE_THROTTLE_BACKOFF', 30)
+
 # For building links in emails.
 SQUEEZE_DEFAULT_HTTP_PROTOCOL = getattr(settings, 'SQUEEZE_DEFAULT_HTTP_PROTOCOL', 'http')
 
@@ -26,5 +87,34 @@ SQUEEZE_DEFAULT_HTTP_PROTOCOL = getattr(settings, 'SQUEEZE_DEFAULT_HTTP_PROTOCOL
 # tasks.
 SQUEEZE_PREFIX = getattr(settings, 'SQUEEZE_PREFIX', '')
 
+# The run_steps task queues one task per active step. Set this to route those tasks to their own celery queue
+# (e.g. 'steps'), and start the workers that should run steps with -Q steps. None uses your default queue.
+SQUEEZE_STEP_QUEUE = getattr(settings, 'SQUEEZE_STEP_QUEUE', None)
+
 SQUEEZE_DEFAULT_FROM_EMAIL = getattr(settings, 'SQUEEZE_DEFAULT_FROM_EMAIL', settings.DEFAULT_FROM_EMAIL)
 
+# When moving subscribers between steps in bulk, how many subscribers get updated per UPDATE statement.
+SQUEEZE_STEP_MOVE_CHUNK_SIZE = getattr(settings, 'SQUEEZE_STEP_MOVE_CHUNK_SIZE', 1000)
+
+# Steps with more active subscribers than this are split into subscriber id ranges ('shards') that run concurrently,
+# each as its own celery task. 0 turns sharding off.
+SQUEEZE_STEP_SHARD_SIZE = getattr(settings, 'SQUEEZE_STEP_SHARD_SIZE', 0)
+
+# Step.run_sharded runs a step's shards on up to this many threads at once, each with its own database connection.
+# None uses the number of CPUs.
+SQUEEZE_STEP_SHARD_WORKERS = getattr(settings, 'SQUEEZE_STEP_SHARD_WORKERS', None)
+
+# A step doesn't run while its run_step_shard tasks do. If none of them has started or finished for this many seconds
+# (e.g. a shard task was lost), the step is free to run again. Keep it above how long a shard takes, retries included.
+SQUEEZE_STEP_SHARD_TIMEOUT = getattr(settings, 'SQUEEZE_STEP_SHARD_TIMEOUT', 60 * 30)
+
+# run_steps only runs steps that are 'dirty' (something moved onto them or they changed) or that asked to be woken up.
+# A step that still has subscribers on it after it ran, and can't tell when they'll be ready to move on (e.g. a
+# decision with a 'now-7 days' rule, or waiting on data from outside squeezemail), is rechecked after this many
+# seconds. 0 rechecks it on every run_steps, like before steps were only run when dirty. Raise it to run fewer steps
+# per tick, if your decisions and drips can wait that long to notice a subscriber has become a match.
+SQUEEZE_STEP_RECHECK_INTERVAL = getattr(settings, 'SQUEEZE_STEP_RECHECK_INTERVAL', 0)
+
+# Drip/Decision queryset rules are compiled and cached. A compiled plan is rebuilt whenever its rules change in the
+# database, this is just the longest one will sit in the cache (in seconds).
+SQUEEZE_RULE_PLAN_CACHE_TIMEOUT = getattr(settings, 'SQUEEZE_RULE_PLAN_CACHE_TIMEOUT', 60 * 60)
@@ -10,7 +10,7 @@ from feincms3.admin import TreeAdmin
 from feincms3.plugins import AlwaysChangedModelForm
 
 from .models import Drip, SendDrip, QuerySetRule, DripSubject, Subscriber, Decision,\
-    Delay, Step, Modify, Funnel, Image, RichText
+    Delay, Step, Modify, Funnel, Image, RichText, BroadcastRun
 from .handlers import configured_message_classes, message_class_for
 
 from content_editor.admin import (
@@ -165,10 +165,33 @@ class DripAdmin(ContentEditor):
     def drip_broadcast_send(self, request, drip_id):
         from django.shortcuts import get_object_or_404
         from django.http import HttpResponse
+        from django.core.urlresolvers import reverse
         drip = get_object_or_404(Drip, id=drip_id)
-        result_tasks = drip.handler().broadcast_run()
+        broadcast_run = drip.handler().broadcast_run()
         mime = 'text/plain'
-        return HttpResponse('Broadcast queued to celery. You may leave this page.', content_type=mime)
+        progress_url = reverse('admin:drip_broadcast_progress', args=[drip.id, broadcast_run.id])
+        return HttpResponse('Broadcast queued to celery. You may leave this page.\n'
+                            'Progress: %s' % request.build_absolute_uri(progress_url), content_type=mime)
+
+    def drip_broadcast_progress(self, request, drip_id, run_id):
+        from django.shortcuts import get_object_or_404
+        from django.http import JsonResponse
+        broadcast_run = get_object_or_404(BroadcastRun, id=run_id, drip_id=drip_id)
+        return JsonResponse(broadcast_run.progress())
+
+    def drip_broadcast_resume(self, request, drip_id, run_id):
+        """
+        Queues whatever the broadcast hasn't sent yet (e.g. after workers died halfway).
+        """
+        from django.shortcuts import get_object_or_404
+        from django.http import JsonResponse, HttpResponseNotAllowed
+        if request.method != 'POST':
+            return HttpResponseNotAllowed(['POST'])
+        broadcast_run = get_object_or_404(BroadcastRun, id=run_id, drip_id=drip_id)
+        chunks = broadcast_run.resume()
+        progress = broadcast_run.progress()
+        progress['resumed_chunks'] = chunks
+        return JsonResponse(progress)
 
     def view_drip_email(self, request, drip_id, subscriber_id):
         from django.shortcuts import get_object_or_404
@@ -222,6 +245,16 @@ class DripAdmin(ContentEditor):
                 r'^(?P<drip_id>[\d]+)/broadcast/send/$',
                 self.av(self.drip_broadcast_send),
                 name='drip_broadcast_send'
+            ),
+            url(
+                r'^(?P<drip_id>[\d]+)/broadcast/(?P<run_id>[\d]+)/progress/$',
+                self.av(self.drip_broadcast_progress),
+                name='drip_broadcast_progress'
+            ),
+            url(
+                r'^(?P<drip_id>[\d]+)/broadcast/(?P<run_id>[\d]+)/resume/$',
+                self.av(self.drip_broadcast_resume),
+                name='drip_broadcast_resume'
             )
         )
         return my_urls + urls
@@ -238,10 +271,25 @@ class SendDripAdmin(admin.ModelAdmin):
 
 admin.site.register(SendDrip, SendDripAdmin)
 
+
+class BroadcastRunAdmin(admin.ModelAdmin):
+    list_display = ['drip', 'started', 'last_activity', 'queued', 'claimed', 'sent', 'failed', 'sent_per_minute']
+    list_filter = ['drip']
+    readonly_fields = ['drip', 'started', 'last_activity', 'queued', 'claimed', 'sent', 'failed']
+    actions = ['resume']
+
+    def resume(self, request, queryset):
+        chunks = sum(broadcast_run.resume() for broadcast_run in queryset)
+        self.message_user(request, '%i chunks of unsent drips queued to celery.' % chunks)
+    resume.short_description = 'Resume (queue whatever is still unsent)'
+
+admin.site.register(BroadcastRun, BroadcastRunAdmin)
+
 # admin.site.register(
 #     Drip, ContentEditor,
 #     # inlines=[
 #     #     RichTextInline,
 #     #     # ContentEditorInline.create(model=Download),
 #     # ],
-# )
\ No newline at end of file
+# )
+
@@ -0,0 +1,159 @@
+"""
+Optional asyncio sending engine for send_drip. Needs Python 3.5+ and aiosmtplib>=2.0 (pip install aiosmtplib).
+Turn it on with SQUEEZE_SEND_ENGINE = 'async'.
+
+One celery process keeps up to SQUEEZE_ASYNC_SMTP_CONCURRENCY SMTP sessions to the relay busy at once, instead of
+sending one email at a time. The event loop runs in its own thread, so the rest of send_drip stays synchronous.
+"""
+import asyncio
+import logging
+import threading
+
+from django.conf import settings
+from django.core.mail.message import sanitize_address
+
+import aiosmtplib
+
+from squeezemail import SQUEEZE_ASYNC_SMTP_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncSMTPSender(object):
+    """
+    Sends Django EmailMessages over a pool of aiosmtplib sessions.
+    Takes the same connection kwargs as django.core.mail.backends.smtp.EmailBackend, defaulting to the EMAIL_* settings.
+    Sessions stay open between send_messages_with_results() calls until close().
+    """
+
+    def __init__(self, host=None, port=None, username=None, password=None, use_tls=None, use_ssl=None, timeout=None,
+                 concurrency=None, throttle=None, **kwargs):
+        self.host = host or settings.EMAIL_HOST
+        self.port = port or settings.EMAIL_PORT
+        self.username = settings.EMAIL_HOST_USER if username is None else username
+        self.password = settings.EMAIL_HOST_PASSWORD if password is None else password
+        self.use_tls = getattr(settings, 'EMAIL_USE_TLS', False) if use_tls is None else use_tls
+        self.use_ssl = getattr(settings, 'EMAIL_USE_SSL', False) if use_ssl is None else use_ssl
+        self.timeout = getattr(settings, 'EMAIL_TIMEOUT', None) if timeout is None else timeout
+        self.concurrency = concurrency or SQUEEZE_ASYNC_SMTP_CONCURRENCY
+        # a SendThrottle. Its waits block, so they're run in the loop's executor.
+        self.throttle = throttle
+        self._loop = None
+        self._thread = None
+        self._idle = []
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open(self):
+        if self._loop is not None:
+            return
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        if self._loop is None:
+            return
+        try:
+            self._run(self._close_sessions())
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._loop = None
+            self._thread = None
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def send_messages_with_results(self, email_messages):
+        """
+        Sends email_messages concurrently. Returns a list of whether each one was sent, in the same order.
+        """
+        if not email_messages:
+            return []
+        self.open()
+        return self._run(self._send_all(list(email_messages)))
+
+    def _new_session(self):
+        return aiosmtplib.SMTP(
+            hostname=self.host,
+            port=self.port,
+            username=self.username or None,
+            password=self.password or None,
+            use_tls=self.use_ssl,
+            start_tls=self.use_tls,
+            timeout=self.timeout,
+        )
+
+    async def _get_session(self):
+        while self._idle:
+            session = self._idle.pop()
+            if session.is_connected:
+                return session
+        session = self._new_session()
+        await session.connect()
+        return session
+
+    @staticmethod
+    async def _quit(session):
+        try:
+            await session.quit()
+        except Exception:
+            session.close()
+
+    async def _close_sessions(self):
+        idle, self._idle = self._idle, []
+        for session in idle:
+            await self._quit(session)
+
+    @staticmethod
+    def _envelope(email_message):
+        encoding = email_message.encoding or settings.DEFAULT_CHARSET
+        from_email = sanitize_address(email_message.from_email, encoding)
+        recipients = [sanitize_address(addr, encoding) for addr in email_message.recipients()]
+        return from_email, recipients, email_message.message().as_bytes(linesep='\r\n')
+
+    async def _send_all(self, email_messages):
+        loop = asyncio.get_event_loop()
+        results = [False] * len(email_messages)
+        pending = iter(enumerate(email_messages))
+
+        async def worker():
+            session = None
+            try:
+                # Each worker keeps one session, and pulls the next message when it's done with the last.
+                for index, email_message in pending:
+                    if not email_message.recipients():
+                        continue
+                    for attempt in (1, 2):
+                        if self.throttle is not None:
+                            await loop.run_in_executor(None, self.throttle.wait, email_message)
+                        try:
+                            if session is None:
+                                session = await self._get_session()
+                            from_email, recipients, data = self._envelope(email_message)
+                            await session.sendmail(from_email, recipients, data)
+                            results[index] = True
+                            break
+                        except Exception as e:
+                            if session is not None and not session.is_connected:
+                                session = None
+                            if attempt == 1 and self.throttle is not None and self.throttle.is_temporary_failure(e):
+                                await loop.run_in_executor(None, self.throttle.back_off, email_message)
+                                continue
+                            logger.warning("Failed to send email message to %s. (%r)", email_message.to, e)
+                            break
+            finally:
+                if session is not None:
+                    self._idle.append(session)
+
+        workers = min(self.concurrency, len(email_messages))
+        await asyncio.gather(*[worker() for _ in range(workers)])
+        return results
@@ -0,0 +1,255 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.core.mail.backends.smtp import EmailBackend as SMTPEmailBackend
+from django.utils.module_loading import import_string
+
+from squeezemail import SQUEEZE_SMTP_POOL_SIZE, SQUEEZE_SMTP_CHECK_INTERVAL, SQUEEZE_SMTP_MAX_AGE
+from squeezemail import SQUEEZE_SEND_ENGINE, SQUEEZE_SEND_WINDOW_SIZE
+from squeezemail.throttle import SendThrottle
+
+logger = logging.getLogger(__name__)
+
+# Pools (and async senders) this process has opened, keyed by backend and relay kwargs. Reset after a fork
+# (celery's prefork pool).
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+
+class ConnectionPool(object):
+    """
+    Keeps up to max_size open email backend connections to one relay, so the SMTP (and TLS) handshake is done once
+    per connection instead of once per chunk or email.
+    Idle connections are health checked (SMTP NOOP) before being handed out again, and reopened if they've gone bad.
+    """
+
+    def __init__(self, backend=None, max_size=None, check_interval=None, max_age=None, **backend_kwargs):
+        self.backend = backend or settings.EMAIL_BACKEND
+        self.backend_kwargs = backend_kwargs
+        self.max_size = max_size or SQUEEZE_SMTP_POOL_SIZE
+        self.check_interval = SQUEEZE_SMTP_CHECK_INTERVAL if check_interval is None else check_interval
+        self.max_age = SQUEEZE_SMTP_MAX_AGE if max_age is None else max_age
+        self._slots = threading.BoundedSemaphore(self.max_size)
+        self._lock = threading.Lock()
+        # (connection, opened_at, last_used_at)
+        self._idle = []
+
+    def open_connection(self):
+        conn = get_connection(backend=self.backend, **self.backend_kwargs)
+        conn.open()
+        now = time.time()
+        return conn, now, now
+
+    @staticmethod
+    def is_alive(conn):
+        """
+        SMTP backends are checked with a NOOP. Backends that don't keep a connection (console, locmem) always are.
+        """
+        smtp = getattr(conn, 'connection', None)
+        if smtp is None:
+            return not hasattr(conn, 'connection')
+        try:
+            return smtp.noop()[0] == 250
+        except Exception:
+            return False
+
+    @staticmethod
+    def close_connection(conn):
+        try:
+            conn.close()
+        except Exception as e:
+            logger.debug("Error closing email connection (%r)", e)
+
+    def reconnect(self, conn):
+        """
+        Reopens conn in place if it isn't alive anymore. Used after a send fails mid-chunk.
+        """
+        if not self.is_alive(conn):
+            logger.info("Email connection to %s dropped, reconnecting.", self.backend)
+            reopen_if_dead(conn)
+        return conn
+
+    def _get(self):
+        now = time.time()
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, opened_at, last_used_at = self._idle.pop()
+            if self.max_age and now - opened_at > self.max_age:
+                self.close_connection(conn)
+                continue
+            if now - last_used_at > self.check_interval and not self.is_alive(conn):
+                self.close_connection(conn)
+                continue
+            return conn, opened_at
+        conn, opened_at, _ = self.open_connection()
+        return conn, opened_at
+
+    @contextmanager
+    def connection(self):
+        """
+        Yields an open connection, blocking while max_size connections to this relay are in use.
+        The connection goes back to the pool afterwards, unless the block raised and it's no longer alive.
+        """
+        self._slots.acquire()
+        try:
+            conn, opened_at = self._get()
+            try:
+                yield conn
+            except Exception:
+                if not self.is_alive(conn):
+                    self.close_connection(conn)
+                    conn = None
+                raise
+            finally:
+                if conn is not None:
+                    with self._lock:
+                        self._idle.append((conn, opened_at, time.time()))
+        finally:
+            self._slots.release()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _, _ in idle:
+            self.close_connection(conn)
+
+
+def get_connection_pool(backend=None, **backend_kwargs):
+    """
+    Returns this process' pool for backend (EMAIL_BACKEND by default) and the given relay kwargs
+    (host, port, username, ...), creating it on first use.
+    """
+    backend = backend or settings.EMAIL_BACKEND
+    key = (backend, tuple(sorted(backend_kwargs.items())))
+    with _pools_lock:
+        reset_pools_after_fork()
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(backend, **backend_kwargs)
+    return pool
+
+
+def get_async_sender(throttle=None, **backend_kwargs):
+    """
+    Returns this process' AsyncSMTPSender for the given relay kwargs, creating it on first use. Its event loop and
+    SMTP sessions stay open between chunks and tasks, until close_connection_pools().
+    """
+    from squeezemail.async_smtp import AsyncSMTPSender
+    key = ('async', tuple(sorted(backend_kwargs.items())))
+    with _pools_lock:
+        reset_pools_after_fork()
+        sender = _pools.get(key)
+        if sender is None:
+            sender = _pools[key] = AsyncSMTPSender(throttle=throttle, **backend_kwargs)
+    return sender
+
+
+def reset_pools_after_fork():
+    """
+    Forgets the parent process' pools in a forked child. Called with _pools_lock held.
+    """
+    global _pools_pid
+    if _pools_pid != os.getpid():
+        # Connections can't be shared with the parent process.
+        _pools.clear()
+        _pools_pid = os.getpid()
+
+
+def close_connection_pools(**kwargs):
+    """
+    Closes every idle pooled connection and async sender. Connected to celery's worker_process_shutdown.
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+def sends_raw_messages(backend=None):
+    """
+    Whether emails are sent straight to an SMTP server as message().as_bytes(), by the 'async' engine or by Django's
+    SMTP backend (EMAIL_BACKEND by default) or a subclass of it. Only then can they be sent pre-serialized
+    (see squeezemail.rendering.RawEmailMessage). The console, file and locmem backends need real messages.
+    """
+    if SQUEEZE_SEND_ENGINE == 'async':
+        return True
+    backend = backend or settings.EMAIL_BACKEND
+    try:
+        return issubclass(import_string(backend), SMTPEmailBackend)
+    except ImportError:
+        return False
+
+
+def reopen_if_dead(conn):
+    if not ConnectionPool.is_alive(conn):
+        ConnectionPool.close_connection(conn)
+        conn.open()
+
+
+def send_message(send, email_message, throttle=None, reconnect=None):
+    """
+    Sends email_message with send(), waiting on throttle (a SendThrottle) first. If the server says to try again later
+    (e.g. 421), every worker backs off, reconnect() is called and it's tried once more. Returns whether it was sent.
+    """
+    for attempt in (1, 2):
+        if throttle is not None:
+            throttle.wait(email_message)
+        try:
+            return bool(send(email_message))
+        except Exception as e:
+            if attempt == 1 and throttle is not None and throttle.is_temporary_failure(e):
+                throttle.back_off(email_message)
+                if reconnect is not None:
+                    reconnect()
+                continue
+            logger.warning("Failed to send email message to %s. (%r)", email_message.to, e)
+            return False
+
+
+def send_messages_with_results(conn, email_messages, throttle=None):
+    """
+    Sends email_messages over conn, like conn.send_messages(), but returns a list of whether each message was sent
+    instead of a count, so one rejected recipient doesn't hide which others went out.
+    Each message is handed to the backend's public send_messages() on its own. A backend that opens a connection
+    (SMTP) reuses the one it already has open, so the whole list still goes out in one session.
+    """
+    send_one = lambda message: conn.send_messages([message])
+    reconnect = lambda: reopen_if_dead(conn)
+    return [send_message(send_one, message, throttle, reconnect=reconnect) for message in email_messages]
+
+
+@contextmanager
+def batch_sender(backend_kwargs=None):
+    """
+    Yields (send_batch, window_size) for the configured SQUEEZE_SEND_ENGINE.
+    send_batch(email_messages) sends them and returns a list of whether each was sent.
+    The default 'sync' engine sends over a pooled EMAIL_BACKEND connection. Only backend_kwargs (the relay) key the
+    pool, so every drip sent through the same relay shares it. 'async' sends over the concurrent aiosmtplib sessions
+    of this process' AsyncSMTPSender for the relay.
+    """
+    backend_kwargs = backend_kwargs or {}
+    throttle = SendThrottle.for_backend_kwargs(backend_kwargs)
+    if SQUEEZE_SEND_ENGINE == 'async':
+        sender = get_async_sender(throttle, **backend_kwargs)
+        # a window smaller than the concurrency would leave sessions idle
+        yield sender.send_messages_with_results, max(SQUEEZE_SEND_WINDOW_SIZE, sender.concurrency)
+        return
+
+    pool = get_connection_pool(settings.EMAIL_BACKEND, **backend_kwargs)
+    with pool.connection() as conn:
+        def send_batch(email_messages):
+            results = send_messages_with_results(conn, email_messages, throttle)
+            if not all(results):
+                # If the relay dropped us, reconnect before the next batch
+                pool.reconnect(conn)
+            return results
+        yield send_batch, SQUEEZE_SEND_WINDOW_SIZE
@@ -1,5 +1,6 @@
 import sys
 import logging
+from itertools import islice
 
 import html2text
 from django.utils.safestring import mark_safe
@@ -17,7 +18,8 @@ else:
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.template import Context, Template
-from django.template.loader import render_to_string
+from django.template.loader import get_template
+from django.utils.encoding import force_text
 from django.utils.functional import cached_property
 from django.core.mail import EmailMultiAlternatives
 # from django.utils.html import strip_tags
@@ -27,18 +29,202 @@ try:
     from django.utils.module_loading import import_module
 except ImportError:
     from django.utils.importlib import import_module
-from content_editor.contents import contents_for_item
 from content_editor.renderer import PluginRenderer
 from .utils import get_token_for_email
 from . import SQUEEZE_CELERY_EMAIL_CHUNK_SIZE, SQUEEZE_DEFAULT_HTTP_PROTOCOL, SQUEEZE_DEFAULT_FROM_EMAIL
+from . import SQUEEZE_SENDDRIP_CREATE_CHUNK_SIZE, SQUEEZE_CELERY_PUBLISH_BATCH_SIZE
+from .connections import get_connection_pool, send_messages_with_results, sends_raw_messages
+from .rendering import MimeSkeleton, sendable_message
+from .throttle import SendThrottle
 from .tasks import send_drip, process_sent
-from .models import SendDrip, Subscriber, RichText, Image
+from .models import Drip, SendDrip, Subscriber, BroadcastRun
+from .splits import SplitAllocator
 from .utils import chunked
 
 
 logger = logging.getLogger(__name__)
 
-HREF_RE = re.compile(r'href\="((\{\{[^}]+\}\}|[^"><])+)"')
+# Template variables and tags in an href are matched whole, so quotes inside them (e.g. {% url "offer" %}) don't end it
+HREF_RE = re.compile(r'href\="((?:\{\{.*?\}\}|\{%.*?%\}|\{(?![{%])|[^"><{])+)"')
+
+# Compiled drips this process has already built, keyed by drip id. See CompiledDrip.for_drip
+_compiled_drips = {}
+
+# Stands in for a subscriber's url params in LinkPlan.plain_text. Has to survive html2text untouched.
+PARAMS_SENTINEL = 'sqparamsx9f27b1'
+
+# Wrapped around a link whose href has template variables in it (e.g. href="/offer/?code={{ subscriber.id }}"),
+# so it can be pointed at the click tracker once the subscriber's values are in.
+DYNAMIC_LINK_START = 'sqlinkx9f27b1'
+DYNAMIC_LINK_END = 'sqendx9f27b1'
+DYNAMIC_LINK_RE = re.compile('%s(.*?)%s' % (DYNAMIC_LINK_START, DYNAMIC_LINK_END), re.DOTALL)
+
+# Template tags, variables and comments, swapped out while a drip body is run through html2text.
+TEMPLATE_SYNTAX_RE = re.compile(r'\{\{.*?\}\}|\{%.*?%\}|\{#.*?#\}', re.DOTALL)
+TEMPLATE_SYNTAX_SENTINEL = 'sqtagx9f27b1n%iz'
+TEMPLATE_SYNTAX_SENTINEL_RE = re.compile(r'sqtagx9f27b1n(\d+)z')
+
+# The most LinkPlans kept per CompiledDrip. A drip needs one per body split (per site, if it's sent from more than one).
+LINK_PLANS_PER_DRIP = 20
+
+
+class LinkPlan(object):
+    """
+    The links in one drip body, found and parsed once: the text between them, and each link's click tracker
+    url with everything but the per subscriber params (extra_keys) already encoded.
+    render() then builds a subscriber's copy with one join.
+    content can be the drip's unrendered template (see CompiledDrip.sources), so the plan, and the html2text run for
+    the plain text, are the same for every subscriber. render_template()/render_plain_template() render it for one.
+    """
+
+    def __init__(self, content, domain, extra_keys=(), tracker_url=None):
+        self.extra_keys = extra_keys = set(extra_keys)
+        self.domain = domain
+        self.tracker_url = tracker_url = tracker_url or urlunparse(
+            (SQUEEZE_DEFAULT_HTTP_PROTOCOL, domain, reverse('squeezemail:link'), '', '', '')
+        )
+        self.parts = []
+        self.links = []
+        last = 0
+        for match in HREF_RE.finditer(content):
+            self.parts.append(content[last:match.start(1)])
+            raw_url = match.group(1)
+            if '{{' in raw_url or '{%' in raw_url:
+                # only known once it's rendered. See render_dynamic_links
+                self.parts[-1] += DYNAMIC_LINK_START + raw_url + DYNAMIC_LINK_END
+                self.links.append('')
+            else:
+                self.links.append(self.tracker_link(raw_url))
+            last = match.end(1)
+        self.parts.append(content[last:])
+
+    def tracker_link(self, raw_url):
+        """
+        The click tracker url for raw_url, up to where the per subscriber params go.
+        """
+        params = self.link_params(raw_url, self.domain)
+        fixed = urlencode([(key, value) for key, value in params.items() if key not in self.extra_keys])
+        return '%s?%s&' % (self.tracker_url, fixed)
+
+    @staticmethod
+    def link_params(raw_url, domain):
+        """
+        raw_url's own query params, plus sq_target (raw_url without them). See DripMessage.encode_url
+        """
+        parsed_url = urlparse(raw_url)
+        if parsed_url.netloc == '':
+            # stick the scheme and netloc in the url if it's missing. This is so urls aren't just '/sublocation/'
+            parsed_url = parsed_url._replace(scheme=SQUEEZE_DEFAULT_HTTP_PROTOCOL, netloc=domain)
+        url_params = dict(parse_qsl(parsed_url.query))
+        # where the user will be redirected to after clicking this link
+        url_params['sq_target'] = urlunparse(parsed_url._replace(query=''))
+        return url_params
+
+    def render(self, encoded_extra_params):
+        pieces = []
+        for part, link in zip(self.parts, self.links):
+            pieces.append(part)
+            if link:
+                pieces.extend((link, encoded_extra_params))
+        pieces.append(self.parts[-1])
+        return ''.join(pieces)
+
+    def render_dynamic_links(self, content, encoded_extra_params):
+        """
+        Points the links whose hrefs were template variables at the click tracker, now that they're rendered.
+        """
+        if DYNAMIC_LINK_START not in content:
+            return content
+        return DYNAMIC_LINK_RE.sub(
+            lambda match: self.tracker_link(match.group(1).strip()) + encoded_extra_params,
+            content
+        )
+
+    @cached_property
+    def plain_text(self):
+        """
+        The body as plain text, with PARAMS_SENTINEL where each link's per subscriber params go.
+        html2text is slow on long emails, so it's only run once per plan. See render_plain
+        Template syntax is kept out of html2text's way, so it can still be rendered afterwards.
+        """
+        syntax = []
+
+        def hide(match):
+            syntax.append(match.group(0))
+            return TEMPLATE_SYNTAX_SENTINEL % (len(syntax) - 1)
+
+        h = html2text.HTML2Text()
+        h.ignore_images = True
+        h.body_width = 0  # wrapping could split the sentinels
+        text = h.handle(TEMPLATE_SYNTAX_RE.sub(hide, self.render(PARAMS_SENTINEL)))
+        return TEMPLATE_SYNTAX_SENTINEL_RE.sub(lambda match: syntax[int(match.group(1))], text)
+
+    def render_plain(self, encoded_extra_params):
+        return self.plain_text.replace(PARAMS_SENTINEL, encoded_extra_params)
+
+    @cached_property
+    def template(self):
+        return Template(self.render(PARAMS_SENTINEL))
+
+    @cached_property
+    def plain_template(self):
+        # html2text already unescaped the html, so the subscriber's values aren't escaped again
+        return Template('{%% autoescape off %%}%s{%% endautoescape %%}' % self.plain_text)
+
+    def render_template(self, context, encoded_extra_params):
+        """
+        The html of a plan made from a template, rendered with a subscriber's context and url params.
+        """
+        rendered = self.template.render(context).replace(PARAMS_SENTINEL, encoded_extra_params)
+        return self.render_dynamic_links(rendered, encoded_extra_params)
+
+    def render_plain_template(self, context, encoded_extra_params):
+        rendered = self.plain_template.render(context).replace(PARAMS_SENTINEL, encoded_extra_params)
+        return self.render_dynamic_links(rendered, encoded_extra_params)
+
+
+class LazyEmailMultiAlternatives(EmailMultiAlternatives):
+    """
+    An EmailMultiAlternatives whose plain body and html alternative are only rendered the first time they're used
+    (normally when the message is serialized to be sent), so e.g. the admin preview, which only shows the html,
+    never renders the plain text.
+    """
+
+    def __init__(self, subject, render_body, from_email, to, render_html, **kwargs):
+        super(LazyEmailMultiAlternatives, self).__init__(subject, '', from_email, to, **kwargs)
+        self._body = None
+        self._alternatives = None
+        self._render_body = render_body
+        self._render_html = render_html
+
+    @property
+    def body(self):
+        if self._body is None:
+            self._body = self._render_body()
+        return self._body
+
+    @body.setter
+    def body(self, value):
+        self._body = value
+
+    @property
+    def alternatives(self):
+        if self._alternatives is None:
+            self._alternatives = [(self._render_html(), 'text/html')]
+        return self._alternatives
+
+    @alternatives.setter
+    def alternatives(self, value):
+        self._alternatives = value
+
+    def render(self):
+        """
+        Renders both now, e.g. in a rendering thread before the message is handed to the one sending it.
+        The render functions are dropped afterwards, so the message can be pickled (e.g. by a process RenderPool).
+        """
+        rendered = self.body, self.alternatives
+        self._render_body = self._render_html = None
+        return rendered
 
 
 def configured_message_classes():
@@ -56,11 +242,113 @@ def message_class_for(name):
     return klass
 
 
+class SendContext(object):
+    """
+    What every DripMessage of a send has in common: the site's domain, the protocol, the click/open/unsubscribe urls,
+    and each drip's from address. Make one per send (a step run, a send_drip chunk) and pass it to each message as
+    send_context, so the Site lookup, url reversing and from address are done once instead of once per email.
+    """
+
+    def __init__(self, domain=None, protocol=None):
+        self.domain = domain or Site.objects.get_current().domain
+        self.protocol = protocol or SQUEEZE_DEFAULT_HTTP_PROTOCOL
+        self.link_url = self.build_url(reverse('squeezemail:link'))
+        self.tracking_pixel_url = self.build_url(reverse('squeezemail:tracking_pixel'))
+        self.unsubscribe_url = self.build_url(reverse('squeezemail:unsubscribe'))
+        self._from_emails = {}
+
+    def build_url(self, path):
+        return urlunparse((self.protocol, self.domain, path, '', '', ''))
+
+    def from_email(self, drip):
+        from_ = self._from_emails.get(drip.id)
+        if from_ is None:
+            if drip.from_email_name and drip.from_email:
+                from_ = "%s <%s>" % (drip.from_email_name, drip.from_email)
+            elif drip.from_email and not drip.from_email_name:
+                from_ = drip.from_email
+            else:
+                from_ = SQUEEZE_DEFAULT_FROM_EMAIL
+            self._from_emails[drip.id] = from_
+        return from_
+
+
+class CompiledDrip(object):
+    """
+    Everything about a drip's message that's the same for every subscriber: the rendered plugin content of each body
+    split test variant compiled into a Template, and the compiled subject, body.html and plain.txt templates.
+    Built once per drip per process, and rebuilt when Drip.lastchanged changes, so sending a message only has to
+    render these with the subscriber's context.
+    """
+    body_template_name = 'squeezemail/email/body.html'
+    plain_template_name = 'squeezemail/email/plain.txt'
+
+    def __init__(self, drip, content_html):
+        self.version = drip.lastchanged
+        if not isinstance(content_html, dict):
+            content_html = {Drip.MAIN_SPLIT: content_html}
+        # split name -> unrendered content. Messages are rendered from its LinkPlan (see link_plan).
+        self.sources = dict((split, force_text(html)) for split, html in content_html.items())
+        # split name -> compiled content
+        self.contents = dict((split, Template(html)) for split, html in self.sources.items())
+        self.content = self.contents[Drip.MAIN_SPLIT]
+        self.splits = SplitAllocator(sorted(self.contents, key=lambda split: (split != Drip.MAIN_SPLIT, split)))
+        self.body = get_template(self.body_template_name)
+        self.plain = get_template(self.plain_template_name)
+        # subject text -> Template. Subjects are split tested, so there can be a few.
+        self._subjects = {}
+        self._link_plans = {}
+        # from address -> MimeSkeleton
+        self._skeletons = {}
+
+    def subject(self, text):
+        template = self._subjects.get(text)
+        if template is None:
+            template = self._subjects[text] = Template(text)
+        return template
+
+    def choose_split(self, drip_id, subscriber_id):
+        """
+        The body split subscriber_id gets. Always the same one for the same subscriber and variants.
+        """
+        return self.splits.choose('body', drip_id, subscriber_id)
+
+    def link_plan(self, content, send_context, extra_keys=()):
+        extra_keys = tuple(sorted(extra_keys))
+        key = (send_context.link_url, extra_keys, content)
+        plan = self._link_plans.get(key)
+        if plan is None:
+            if len(self._link_plans) >= LINK_PLANS_PER_DRIP:
+                self._link_plans.clear()
+            plan = self._link_plans[key] = LinkPlan(content, send_context.domain, extra_keys, send_context.link_url)
+        return plan
+
+    def mime_skeleton(self, from_email):
+        skeleton = self._skeletons.get(from_email)
+        if skeleton is None:
+            skeleton = self._skeletons[from_email] = MimeSkeleton(from_email)
+        return skeleton
+
+    @classmethod
+    def for_drip(cls, drip, render_body):
+        """
+        Returns drip's CompiledDrip, calling render_body() for the content if it has to be built.
+        render_body() returns the html, or a dict of each body split's html.
+        """
+        compiled = _compiled_drips.get(drip.id)
+        if compiled is None or compiled.version != drip.lastchanged:
+            compiled = _compiled_drips[drip.id] = cls(drip, render_body())
+        return compiled
+
+
 class DripMessage(object):
 
-    def __init__(self, drip, subscriber):
+    def __init__(self, drip, subscriber, send_context=None):
         self.drip = drip
         self.subscriber = subscriber
+        self.send_context = send_context or SendContext()
+        # the LinkPlan of this message's content, set when the context is built
+        self.link_plan = None
         self._context = None
         self._subject = None
         self._body = None
@@ -70,24 +358,31 @@ class DripMessage(object):
 
     @cached_property
     def from_email(self):
-        if self.drip.from_email_name and self.drip.from_email:
-            from_ = "%s <%s>" % (self.drip.from_email_name, self.drip.from_email)
-        elif self.drip.from_email and not self.drip.from_email_name:
-            from_ = self.drip.from_email
-        else:
-            from_ = SQUEEZE_DEFAULT_FROM_EMAIL
-        return from_
+        return self.send_context.from_email(self.drip)
 
     @property
     def from_email_name(self):
         return self.drip.from_email_name
 
+    @cached_property
+    def compiled(self):
+        return CompiledDrip.for_drip(self.drip, self.render_body)
+
     def render_body(self):
+        """
+        The drip's content, rendered from its plugins, for each body split (see Drip.BODY_SPLITS) that has any.
+        Only called once per drip per process (see CompiledDrip), so it can't depend on the subscriber.
+        Use the context for that.
+        """
         # import the custom renderer and do renderer.plugins() instead
-        contents = contents_for_item(self.drip, plugins=[Image, RichText])
-        # assert False, contents['body']
-        body = renderer.render(contents['body']) #TODO: get split test feincms content here
-        return body
+        return dict((split, renderer.render(plugins)) for split, plugins in self.drip.get_split_test_body().items())
+
+    @cached_property
+    def split(self):
+        """
+        Which body split test variant this subscriber gets.
+        """
+        return self.compiled.choose_split(self.drip.id, self.subscriber.id)
 
     @property
     def context(self):
@@ -101,49 +396,71 @@ class DripMessage(object):
                 'tracking_pixel': self.tracking_pixel,
                 'unsubscribe_link': self.unsubscribe_link
                 })
-            context['content'] = mark_safe(self.replace_urls(Template(self.render_body()).render(context)))
+            # The plan is made from the unrendered content, so it's the same for every subscriber
+            source = self.compiled.sources[self.split]
+            self.link_plan = self.compiled.link_plan(source, self.send_context, self.extra_url_params.keys())
+            context['content'] = mark_safe(self.link_plan.render_template(context, self.encoded_extra_url_params))
             self._context = context
         return self._context
 
     @cached_property
     def subject_model(self):
-        return self.drip.choose_split_test_subject
+        return self.drip.choose_subject(self.subscriber.id)
 
     @property
     def subject(self):
         if not self._subject:
-            self._subject = Template(self.subject_model.text).render(self.context)
+            self._subject = self.compiled.subject(self.subject_model.text).render(self.context)
         return self._subject
 
     @property
     def body(self):
         if not self._body:
-            self._body = render_to_string('squeezemail/email/body.html', self.context)
+            self._body = self.compiled.body.render(self.context.flatten())
         return self._body
 
     @property
     def plain(self):
+        """
+        The body run through html2text, which is only done once per drip body (see LinkPlan.plain_text).
+        """
         if not self._plain:
-            h = html2text.HTML2Text()
-            h.ignore_images = True
-            self._plain = render_to_string('squeezemail/email/plain.txt', self.context)
+            context = self.context.flatten()
+            context['content'] = mark_safe(
+                self.link_plan.render_plain_template(self.context, self.encoded_extra_url_params)
+            )
+            self._plain = self.compiled.plain.render(context)
         return self._plain
 
     @property
     def message(self):
         if not self._message:
-            self._message = EmailMultiAlternatives(self.subject, self.plain, self.from_email, [self.subscriber.email])
-            self._message.attach_alternative(self.body, 'text/html')
+            self._message = LazyEmailMultiAlternatives(
+                self.subject,
+                lambda: self.plain,
+                self.from_email,
+                [self.subscriber.email],
+                lambda: self.body
+            )
         return self._message
 
+    @cached_property
+    def raw_message(self):
+        """
+        The same email as message, but as bytes ready for sendmail, spliced into the drip's MimeSkeleton.
+        Sent instead of message when SQUEEZE_PRESERIALIZE_MIME is on (see sendable_message).
+        """
+        skeleton = self.compiled.mime_skeleton(self.from_email)
+        return skeleton.assemble(self.subscriber.email, self.subject, self.plain, self.body)
+
     def replace_urls(self, content):
-        offset = 0
-        for match in HREF_RE.finditer(content):
-            link = match.group(1)
-            replacelink = self.encode_url(link)
-            content = ''.join((content[:match.start(1)+offset], replacelink, content[match.end(1)+offset:]))
-            offset += len(replacelink) - len(match.group(1))
-        return content
+        """
+        Points every link in content at our click tracker (see encode_url for what the links turn into).
+        Where the links are and what they point to is worked out once per drip body (see LinkPlan),
+        so only this subscriber's params are added here. context uses the LinkPlan directly.
+        """
+        plan = self.compiled.link_plan(content, self.send_context, self.extra_url_params.keys())
+        return plan.render(self.encoded_extra_url_params)
 
     def encode_url(self, raw_url):
         """
@@ -198,40 +515,35 @@ class DripMessage(object):
             'sq_subscriber_id': self.subscriber.id,
             'sq_drip_id': self.drip.id,
             'sq_token': self.get_email_token(),
-            'sq_subject_id': self.subject_model.id
+            'sq_subject_id': self.subject_model.id,
+            'sq_split': self.split,
         }
         return params
 
+    @cached_property
+    def encoded_extra_url_params(self):
+        return urlencode(self.extra_url_params)
+
     def get_email_token(self):
         if not self._token:
             self._token = str(get_token_for_email(self.subscriber.email))
         return self._token
 
-    @cached_property
+    @property
     def current_domain(self):
-        return Site.objects.get_current().domain
+        return self.send_context.domain
 
     @cached_property
     def tracking_pixel(self):
-        p = urlparse('')._replace(
-            scheme=SQUEEZE_DEFAULT_HTTP_PROTOCOL,
-            netloc=self.current_domain,
-            path=reverse('squeezemail:tracking_pixel'),
-            query=urlencode(self.extra_url_params)
-        )
-        return mark_safe(urlunparse(p))
+        return mark_safe('%s?%s' % (self.send_context.tracking_pixel_url, self.encoded_extra_url_params))
 
     @cached_property
     def unsubscribe_link(self):
-        url_params = {'sq_email': self.subscriber.email}
-        url_params.update(self.extra_url_params)
-        l = urlparse('')._replace(
-            scheme=SQUEEZE_DEFAULT_HTTP_PROTOCOL,
-            netloc=self.current_domain,
-            path=reverse('squeezemail:unsubscribe'),
-            query=urlencode(url_params)
-        )
-        return mark_safe(urlunparse(l))
+        return mark_safe('%s?%s&%s' % (
+            self.send_context.unsubscribe_url,
+            urlencode({'sq_email': self.subscriber.email}),
+            self.encoded_extra_url_params
+        ))
 
 
 class HandleDrip(object):
@@ -273,9 +585,13 @@ class HandleDrip(object):
         return
 
     def broadcast_run(self):
+        """
+        Sends this drip to everyone on the queryset through celery. Returns the BroadcastRun tracking the send.
+        """
+        broadcast_run = BroadcastRun.objects.create(drip=self.drip_model)
         self.create_unsent_drips()
-        results = self.create_tasks_for_unsent_drips()
-        return results
+        self.create_tasks_for_unsent_drips(broadcast_run_id=broadcast_run.id)
+        return broadcast_run
 
     def prune(self):
         """
@@ -297,59 +613,101 @@ class HandleDrip(object):
         """
         MessageClass = message_class_for(self.drip_model.message_class)
 
-        count = 0
-        for subscriber in self.get_queryset():
-            message_instance = MessageClass(self.drip_model, subscriber)
-            try:
-                # Make sure they haven't received this drip just before sending.
-                SendDrip.objects.get(drip_id=self.drip_model.id, subscriber_id=subscriber.id, sent=True)
-                continue
-            except SendDrip.DoesNotExist:
-                result = message_instance.message.send()
-                if result:
-                    SendDrip.objects.create(drip=self.drip_model, subscriber=subscriber, sent=True)
-                    if next_step:
-                        subscriber.move_to_step(next_step.id)
-                    # send a 'sent' event to google analytics
-                    process_sent.delay(
-                        user_id=subscriber.user_id,
-                        subject=message_instance.subject,
-                        drip_id=self.drip_model.id,
-                        drip_name=self.drip_model.name,
-                        source='step',
-                        split='main'
-                    )
-                    count += 1
-            except Exception as e:
-                logging.error("Failed to send drip %s to subscriber %s: %s" % (str(self.drip_model.id), str(subscriber), e))
-
-        return count
+        sent_ids = []
+        raw = sends_raw_messages()
+        pool = get_connection_pool()
+        throttle = SendThrottle()
+        send_context = SendContext()
+        try:
+            with pool.connection() as conn:
+                for subscriber in self.get_queryset():
+                    message_instance = MessageClass(self.drip_model, subscriber, send_context=send_context)
+                    try:
+                        # Make sure they haven't received this drip just before sending.
+                        SendDrip.objects.get(drip_id=self.drip_model.id, subscriber_id=subscriber.id, sent=True)
+                        continue
+                    except SendDrip.DoesNotExist:
+                        result = send_messages_with_results(conn, [sendable_message(message_instance, raw)], throttle)[0]
+                        if result:
+                            SendDrip.objects.create(drip=self.drip_model, subscriber=subscriber, sent=True, state=SendDrip.SENT,
+                                                    split=getattr(message_instance, 'split', Drip.MAIN_SPLIT))
+                            sent_ids.append(subscriber.id)
+                            # send a 'sent' event to google analytics
+                            process_sent.delay(
+                                user_id=subscriber.user_id,
+                                subject=message_instance.subject,
+                                drip_id=self.drip_model.id,
+                                drip_name=self.drip_model.name,
+                                source='step',
+                                split=getattr(message_instance, 'split', Drip.MAIN_SPLIT)
+                            )
+                    except Exception as e:
+                        logging.error("Failed to send drip %s to subscriber %s: %s" % (str(self.drip_model.id), str(subscriber), e))
+                        pool.reconnect(conn)
+        finally:
+            # Everyone who got the drip moves on in one go, so the next step's Delay is only looked up once per send.
+            if next_step and sent_ids:
+                Subscriber.objects.move_ids_to_step(sent_ids, next_step.id)
+
+        return len(sent_ids)
 
     def create_unsent_drips(self):
         """
         Create an unsent SendDrip objects for every subscriber_id in the queryset.
-        Used for huge sendouts like broadcasts.
+        Used for huge sendouts like broadcasts, so the ids are streamed and the SendDrips are bulk created in chunks.
+        Returns how many were created and how many already existed (see SendDripManager.bulk_create_unsent).
         """
         drip_id = self.drip_model.id
-        subscriber_id_list = self.get_queryset().values_list('id', flat=True)
-
-        for subscriber_id in subscriber_id_list:
-            try:
-                sentdrip = SendDrip.objects.create(drip_id=drip_id, subscriber_id=subscriber_id, sent=False)
-            except Exception as e:
-                logger.warning("Failed to create SendDrip for subscriber_id %i & drip_id %i. (%r)", subscriber_id, drip_id, e)
-        return
+        subscriber_id_list = self.get_queryset().values_list('id', flat=True).iterator()
+
+        created = 0
+        existing = 0
+        for chunk in chunked(subscriber_id_list, SQUEEZE_SENDDRIP_CREATE_CHUNK_SIZE):
+            chunk_created, chunk_existing = SendDrip.objects.bulk_create_unsent(drip_id, chunk)
+            created += chunk_created
+            existing += chunk_existing
+        logger.info("Drip %i: created %i unsent SendDrips, %i already existed", drip_id, created, existing)
+        return created, existing
+
+    def unsent_subscriber_id_chunks(self, chunk_size=None):
+        """
+        Yields lists of the subscriber ids that haven't been sent this drip yet, chunk_size at a time.
+        Pages through SendDrip by subscriber_id (subscriber_id > last one seen) instead of loading every id,
+        so memory stays flat no matter how big the broadcast is.
+        """
+        chunk_size = chunk_size or SQUEEZE_CELERY_EMAIL_CHUNK_SIZE
+        last_subscriber_id = 0
+        while True:
+            chunk = list(
+                SendDrip.objects.filter(drip_id=self.drip_model.id, sent=False, subscriber_id__gt=last_subscriber_id)
+                .order_by('subscriber_id')
+                .values_list('subscriber_id', flat=True)[:chunk_size]
+            )
+            if not chunk:
+                return
+            yield chunk
+            last_subscriber_id = chunk[-1]
 
     def create_tasks_for_unsent_drips(self, **kwargs):
         """
         Grab all of the SendDrips that haven't been sent yet, and queue up some celery tasks for them.
+        Chunks are queued as soon as they're read, and every SQUEEZE_CELERY_PUBLISH_BATCH_SIZE tasks share
+        one producer (broker connection). Returns how many tasks were queued.
+        Pass broadcast_run_id to count the queued subscribers (and what the tasks do) on that BroadcastRun.
         """
-        result_tasks = []
         kwargs['drip_id'] = self.drip_model.id
-        # Get a fresh list of all user IDs that haven't received this drip yet.
-        subscriber_id_list = SendDrip.objects.filter(drip_id=self.drip_model.id, sent=False).values_list('subscriber_id', flat=True)
-        chunk_size = SQUEEZE_CELERY_EMAIL_CHUNK_SIZE
-        for chunk in chunked(subscriber_id_list, chunk_size):
-            result_tasks.append(send_drip.delay(chunk, **kwargs))
-        logging.info('drips queued')
-        return result_tasks
+        chunks = self.unsent_subscriber_id_chunks()
+        queued = 0
+        batch_queued = True
+        while batch_queued:
+            batch_queued = 0
+            batch_subscribers = 0
+            with send_drip.app.producer_or_acquire() as producer:
+                for chunk in islice(chunks, SQUEEZE_CELERY_PUBLISH_BATCH_SIZE):
+                    send_drip.apply_async(args=[chunk], kwargs=kwargs, producer=producer)
+                    batch_queued += 1
+                    batch_subscribers += len(chunk)
+            BroadcastRun.increment(kwargs.get('broadcast_run_id'), queued=batch_subscribers)
+            queued += batch_queued
+        logging.info('%i drip chunks queued', queued)
+        return queued
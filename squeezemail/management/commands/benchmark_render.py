@@ -0,0 +1,53 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = "Renders a drip for active subscribers with different render pool sizes, and prints messages/sec for each. " \
+           "Nothing is sent or saved."
+
+    def add_arguments(self, parser):
+        parser.add_argument('drip_id', type=int)
+        parser.add_argument(
+            '--count',
+            type=int,
+            dest='count',
+            default=500,
+            help='How many subscribers to render the drip for.')
+        parser.add_argument(
+            '--sizes',
+            dest='sizes',
+            default='0,1,2,4,8',
+            help='Comma separated render pool sizes to try. 0 renders inline.')
+        parser.add_argument(
+            '--pool',
+            dest='pool',
+            default='thread',
+            choices=['thread', 'process'],
+            help='Render on threads or processes.')
+
+    def handle(self, *args, **options):
+        from squeezemail.handlers import message_class_for, SendContext
+        from squeezemail.models import Drip, Subscriber
+        from squeezemail.rendering import RenderPool
+
+        try:
+            drip = Drip.objects.get(id=options['drip_id'])
+        except Drip.DoesNotExist:
+            raise CommandError("Drip %i doesn't exist" % options['drip_id'])
+        MessageClass = message_class_for(drip.message_class)
+        subscribers = list(Subscriber.objects.select_related('user').filter(is_active=True)[:options['count']])
+        if not subscribers:
+            raise CommandError("There are no active subscribers to render for")
+        send_context = SendContext()
+        # compile the drip's templates before timing anything
+        list(RenderPool(size=0).render(MessageClass, drip, send_context, subscribers[:1]))
+
+        for size in [int(size) for size in options['sizes'].split(',')]:
+            pool = RenderPool(size=size, kind=options['pool'], serialize=True)
+            start = time.time()
+            rendered = sum(1 for _ in pool.render(MessageClass, drip, send_context, subscribers))
+            elapsed = time.time() - start
+            self.stdout.write('%s pool size %i: %i messages in %.2fs, %.1f messages/sec' % (
+                options['pool'], size, rendered, elapsed, rendered / elapsed if elapsed else 0))
@@ -4,8 +4,44 @@ from django.db.models import Q
 
 
 class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--parallel',
+            action='store_true',
+            dest='parallel',
+            default=False,
+            help='Queue one celery task per active step and wait for all of them to finish.')
+        parser.add_argument(
+            '--shard-size',
+            type=int,
+            dest='shard_size',
+            default=0,
+            help='Run steps with more active subscribers than this in concurrent subscriber id ranges. '
+                 'With --parallel, each range is queued as its own celery task.')
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            dest='all',
+            default=False,
+            help="Run every active step, not just the ones that are dirty or due to wake up.")
+
     def handle(self, *args, **options):
         from squeezemail.models import Step
 
-        for step in Step.objects.filter(is_active=True):
-            step.run()
+        if options['parallel']:
+            from squeezemail.tasks import get_step_tasks
+
+            results = get_step_tasks(run_all=options['all'], shard_size=options['shard_size']).apply_async().get()
+            ran = [result for result in results if result]
+            self.stdout.write('Ran %i of %i steps' % (len(ran), len(results)))
+            return
+
+        shard_size = options['shard_size']
+        steps = Step.objects.filter(is_active=True) if options['all'] else Step.objects.runnable()
+        for step in steps:
+            if shard_size and step.get_active_subscribers_count() > shard_size:
+                results, failed = step.run_sharded(shard_size=shard_size)
+                for min_id, max_id in failed:
+                    self.stderr.write('Step %i shard %r-%r failed' % (step.id, min_id, max_id))
+            else:
+                step.run()
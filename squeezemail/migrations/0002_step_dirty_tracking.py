@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('squeezemail', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='step',
+            name='is_dirty',
+            field=models.BooleanField(db_index=True, default=True, editable=False, help_text='Set when something happened that this step needs to run for.'),
+        ),
+        migrations.AddField(
+            model_name='step',
+            name='wake_at',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, help_text="When this step needs to run again, even if it isn't dirty (e.g. a delay coming due).", null=True),
+        ),
+    ]
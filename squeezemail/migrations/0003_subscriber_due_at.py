@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def set_due_at(apps, schema_editor):
+    """
+    Works out due_at for everyone already waiting on a Delay step.
+    """
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    Delay = apps.get_model('squeezemail', 'Delay')
+    Step = apps.get_model('squeezemail', 'Step')
+    Subscriber = apps.get_model('squeezemail', 'Subscriber')
+    try:
+        delay_type = ContentType.objects.get(app_label='squeezemail', model='delay')
+    except ContentType.DoesNotExist:
+        return
+    for step in Step.objects.filter(content_type=delay_type):
+        try:
+            delay = Delay.objects.get(id=step.object_id)
+        except Delay.DoesNotExist:
+            continue
+        Subscriber.objects.filter(step=step).update(due_at=models.F('step_timestamp') + delay.duration)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('squeezemail', '0002_step_dirty_tracking'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscriber',
+            name='due_at',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, help_text="When the subscriber is due to move on from the Delay step they're on.", null=True),
+        ),
+        migrations.RunPython(set_due_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def set_sent_state(apps, schema_editor):
+    SendDrip = apps.get_model('squeezemail', 'SendDrip')
+    SendDrip.objects.filter(sent=True).update(state='sent')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('squeezemail', '0003_subscriber_due_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='senddrip',
+            name='state',
+            field=models.CharField(choices=[('unsent', 'Unsent'), ('sending', 'Sending'), ('sent', 'Sent'), ('failed', 'Failed')], db_index=True, default='unsent', editable=False, max_length=10),
+        ),
+        migrations.AddField(
+            model_name='senddrip',
+            name='claim',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=32, null=True),
+        ),
+        migrations.AddField(
+            model_name='senddrip',
+            name='lease_expires',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(set_sent_state, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('squeezemail', '0004_senddrip_claim'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BroadcastRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_activity', models.DateTimeField(blank=True, null=True)),
+                ('queued', models.PositiveIntegerField(default=0, help_text='Subscribers queued to celery, including resumes.')),
+                ('claimed', models.PositiveIntegerField(default=0, help_text='Subscribers a worker started sending to.')),
+                ('sent', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0, help_text="Claimed but not sent. They're retried on resume.")),
+                ('drip', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='broadcast_runs', to='squeezemail.Drip')),
+            ],
+            options={
+                'ordering': ['-started'],
+            },
+        ),
+    ]
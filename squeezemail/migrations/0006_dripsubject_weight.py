@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('squeezemail', '0005_broadcastrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dripsubject',
+            name='weight',
+            field=models.PositiveIntegerField(default=1, help_text="How often this subject is sent compared to the drip's other enabled subjects. 0 stops sending it."),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def set_main_split(apps, schema_editor):
+    # Everything sent so far was the main body
+    SendDrip = apps.get_model('squeezemail', 'SendDrip')
+    SendDrip.objects.filter(sent=True).update(split='main')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('squeezemail', '0006_dripsubject_weight'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='senddrip',
+            name='split',
+            field=models.CharField(blank=True, editable=False, max_length=20, null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='senddrip',
+            index_together=set([('drip', 'split')]),
+        ),
+        migrations.RunPython(set_main_split, migrations.RunPython.noop),
+    ]
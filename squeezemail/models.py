@@ -1,34 +1,45 @@
-import functools
-import operator
 import logging
+import multiprocessing
+import uuid
 # from collections import OrderedDict
 from _md5 import md5
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 
-from cte_forest.models import CTENode
+from cte_forest.models import CTENode, CTENodeManager
 from cte_forest.fields import DepthField, PathField, OrderingField
 from django.db.models import Q
 from gfklookupwidget.fields import GfkLookupField
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.db import models, connection, transaction, IntegrityError
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
 from django.conf import settings
 from django.utils.functional import cached_property
 from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.utils import timezone
 
-# just using this to parse, but totally insane package naming...
-# https://bitbucket.org/schinckel/django-timedelta-field/
-import timedelta as djangotimedelta
 # from mptt.models import MPTTModel
 
 from squeezemail import SQUEEZE_DRIP_HANDLER
 from squeezemail import SQUEEZE_PREFIX
 from squeezemail import SQUEEZE_SUBSCRIBER_MANAGER
-from squeezemail.utils import class_for, get_token_for_email
+from squeezemail import SQUEEZE_STEP_MOVE_CHUNK_SIZE
+from squeezemail import SQUEEZE_STEP_SHARD_SIZE
+from squeezemail import SQUEEZE_STEP_SHARD_WORKERS
+from squeezemail import SQUEEZE_STEP_SHARD_TIMEOUT
+from squeezemail import SQUEEZE_STEP_RECHECK_INTERVAL
+from squeezemail import SQUEEZE_SEND_LEASE
+from squeezemail.rules import CompiledRule, get_rule_plan, expire_rule_plan
+from squeezemail.signals import subscribers_moved
+from squeezemail.splits import SplitAllocator
+from squeezemail.utils import class_for, get_token_for_email, chunked
 
 # from mptt.models import MPTTModel, TreeForeignKey
+from content_editor.contents import contents_for_item
 from content_editor.models import (
     Template, Region, create_plugin_base
 )
@@ -103,6 +114,36 @@ step_choices = models.Q(app_label='squeezemail', model='decision') |\
         models.Q(app_label='squeezemail', model='modify')
 
 
+class StepManager(CTENodeManager):
+
+    def runnable(self, now=None):
+        """
+        Active steps that have something to do: they're dirty (a subscriber moved onto them, or they
+        or their rules changed), the time they asked to be woken up at has passed, or they're
+        delays with a subscriber that's come due (an index range scan over Subscriber.due_at).
+        """
+        now = now or timezone.now()
+        due_step_ids = Subscriber.objects.filter(
+            due_at__lte=now,
+            is_active=True,
+            step__content_type=ContentType.objects.get_for_model(Delay)
+        ).values('step_id')
+        return self.filter(is_active=True).filter(Q(is_dirty=True) | Q(wake_at__lte=now) | Q(id__in=due_step_ids))
+
+    def mark_dirty(self, step_ids):
+        # step_ids is a list, not a Step queryset: MySQL won't UPDATE a table with a subquery on that same table
+        return self.model._base_manager.filter(id__in=step_ids).update(is_dirty=True)
+
+    def ids_for(self, content_type_id, object_id):
+        """
+        Ids of the steps pointing at a delay/decision/drip, as a list.
+        Step queries are wrapped in the tree CTE, which isn't valid SQL inside a subquery,
+        so steps are always looked up with a query of their own first.
+        """
+        return list(self.model._base_manager.filter(content_type_id=content_type_id, object_id=object_id)
+                    .values_list('id', flat=True))
+
+
 class Step(CTENode):
     description = models.CharField(max_length=75, null=True, blank=True)
     content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE, limit_choices_to=step_choices, null=True, blank=True)
@@ -110,6 +151,10 @@ class Step(CTENode):
     content_object = GenericForeignKey('content_type', 'object_id')
     is_active = models.BooleanField(verbose_name="Active", default=True, help_text="If not active, subscribers will still be allowed to move to this step, but this step won't run until it's active. Consider this a good way to 'hold' subscribers on this step. Note: Step children will still run.")
     position = models.PositiveIntegerField(db_index=True, editable=False, default=0)
+    is_dirty = models.BooleanField(default=True, db_index=True, editable=False, help_text="Set when something happened that this step needs to run for.")
+    wake_at = models.DateTimeField(null=True, blank=True, db_index=True, editable=False, help_text="When this step needs to run again, even if it isn't dirty (e.g. a delay coming due).")
+
+    objects = StepManager()
 
     _cte_node_path = 'cte_path'
     _cte_node_order_by = ('position',)
@@ -118,6 +163,11 @@ class Step(CTENode):
     def __str__(self):
         return "%s" % self.description if self.description else str(self.content_object)
 
+    def save(self, *args, **kwargs):
+        # Changing a step (activating it, pointing it at a different object) means it should run again
+        self.is_dirty = True
+        return super(Step, self).save(*args, **kwargs)
+
     @cached_property
     def lock_id(self):
         hexdigest = md5(str(SQUEEZE_PREFIX).encode('utf-8') +
@@ -134,14 +184,175 @@ class Step(CTENode):
 
     def run(self):
         if self.acquire_lock():
-            # get all subscribers currently on this step who are active
+            if self.shards_running():
+                # run_step handed this step's subscribers to run_step_shard tasks that haven't all finished
+                self.release_lock()
+                logger.debug('Step %i shards are still running', self.id)
+                return
+            try:
+                self.mark_clean()
+                # get all subscribers currently on this step who are active
+                qs = self.subscribers.filter(is_active=True)
+                # do what this step needs to do (e.g. decision)
+                ret = self.content_object.step_run(self, qs)
+                self.wake_up_at(self.get_wake_at(qs))
+            except Exception:
+                Step.objects.mark_dirty([self.id])
+                raise
+            finally:
+                self.release_lock()
+            return ret
+        else:
+            logger.debug('Step %i is already running', self.id)
+
+    def mark_clean(self):
+        """
+        Called right before the step runs. Anything that happens to the step while it's running marks it dirty again.
+        """
+        return Step._base_manager.filter(id=self.id).update(is_dirty=False, wake_at=None)
+
+    def wake_up_at(self, wake_at):
+        """
+        Makes sure the step runs again by wake_at. Only ever moves wake_at earlier.
+        """
+        if wake_at is None:
+            return 0
+        return Step._base_manager.filter(id=self.id)\
+            .filter(Q(wake_at__isnull=True) | Q(wake_at__gt=wake_at))\
+            .update(wake_at=wake_at)
+
+    def get_wake_at(self, qs, now=None):
+        """
+        When this step needs to run again even if nothing moves onto it.
+        A step type can work this out itself with get_wake_at(step, qs, now). Otherwise,
+        if any subscribers are still left on the step, they're rechecked after SQUEEZE_STEP_RECHECK_INTERVAL.
+        """
+        now = now or timezone.now()
+        get_wake_at = getattr(self.content_object, 'get_wake_at', None)
+        if get_wake_at:
+            return get_wake_at(self, qs, now)
+        if qs.exists():
+            return now + timedelta(seconds=SQUEEZE_STEP_RECHECK_INTERVAL)
+        return None
+
+    def get_shard_ranges(self, shard_size=None):
+        """
+        Splits the active subscribers on this step into (min_id, max_id) ranges of about shard_size subscribers.
+        Ranges are half open (min_id <= id < max_id), and the first and last are unbounded (None),
+        so subscribers that arrive while the shards run aren't missed.
+        """
+        shard_size = shard_size or SQUEEZE_STEP_SHARD_SIZE
+        if not shard_size:
+            return [(None, None)]
+        subscriber_ids = self.subscribers.filter(is_active=True).order_by('id').values_list('id', flat=True)
+        boundaries = [chunk[0] for chunk in chunked(subscriber_ids.iterator(), shard_size)][1:]
+        return list(zip([None] + boundaries, boundaries + [None]))
+
+    def get_shard_lock_id(self, min_id=None, max_id=None):
+        return '{0}-{1}-{2}'.format(self.lock_id, min_id, max_id)
+
+    @cached_property
+    def shards_lock_id(self):
+        return '{0}-shards'.format(self.lock_id)
+
+    @cached_property
+    def shards_heartbeat_id(self):
+        return '{0}-heartbeat'.format(self.shards_lock_id)
+
+    def acquire_shards_lock(self, shard_count):
+        """
+        Held while shards queued as separate tasks are still running. The value counts down as each shard finishes.
+        It only holds while the shards keep touching it (see touch_shards_lock), so a lost shard task doesn't
+        keep the step from running for longer than SQUEEZE_STEP_SHARD_TIMEOUT.
+        """
+        if self.shards_running():
+            return False
+        cache.set(self.shards_lock_id, shard_count, LOCK_EXPIRE)
+        self.touch_shards_lock()
+        return True
+
+    def touch_shards_lock(self):
+        """
+        Called when a shard starts or finishes, to show the step's shards are still running.
+        """
+        cache.set(self.shards_heartbeat_id, 'true', SQUEEZE_STEP_SHARD_TIMEOUT)
+
+    def release_shard(self):
+        try:
+            remaining = cache.decr(self.shards_lock_id)
+        except ValueError:
+            # lock already expired
+            return
+        if remaining <= 0:
+            cache.delete_many([self.shards_lock_id, self.shards_heartbeat_id])
+        else:
+            self.touch_shards_lock()
+
+    def shards_running(self):
+        return len(cache.get_many([self.shards_lock_id, self.shards_heartbeat_id])) == 2
+
+    def run_shard(self, min_id=None, max_id=None):
+        """
+        Runs this step for the subscribers in one range from get_shard_ranges.
+        Every range has its own lock, so a failed shard can be run again without touching the others.
+        """
+        lock_id = self.get_shard_lock_id(min_id, max_id)
+        if not cache.add(lock_id, 'true', LOCK_EXPIRE):
+            logger.debug('Step %i shard %r-%r is already running', self.id, min_id, max_id)
+            return
+        try:
             qs = self.subscribers.filter(is_active=True)
-            # do what this step needs to do (e.g. decision)
+            if min_id is not None:
+                qs = qs.filter(id__gte=min_id)
+            if max_id is not None:
+                qs = qs.filter(id__lt=max_id)
             ret = self.content_object.step_run(self, qs)
-            self.release_lock()
+            self.wake_up_at(self.get_wake_at(qs))
             return ret
-        else:
+        except Exception:
+            Step.objects.mark_dirty([self.id])
+            raise
+        finally:
+            cache.delete(lock_id)
+
+    def run_sharded(self, shard_size=None, max_workers=None):
+        """
+        Runs every shard of this step concurrently in a thread pool of up to max_workers (SQUEEZE_STEP_SHARD_WORKERS)
+        threads, under the step's own lock.
+        Returns a list of (min_id, max_id, result) and a list of the (min_id, max_id) ranges that failed,
+        which can each be retried with run_shard.
+        """
+        if not self.acquire_lock():
             logger.debug('Step %i is already running', self.id)
+            return [], []
+
+        def run_shard_in_thread(shard):
+            try:
+                return self.run_shard(*shard)
+            finally:
+                # every thread gets its own database connection
+                connection.close()
+
+        results = []
+        failed = []
+        try:
+            if self.shards_running():
+                logger.debug('Step %i shards are still running', self.id)
+                return results, failed
+            self.mark_clean()
+            shards = self.get_shard_ranges(shard_size)
+            max_workers = max_workers or SQUEEZE_STEP_SHARD_WORKERS or multiprocessing.cpu_count()
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(shards))) as executor:
+                futures = [(shard, executor.submit(run_shard_in_thread, shard)) for shard in shards]
+                for shard, future in futures:
+                    try:
+                        results.append(shard + (future.result(),))
+                    except Exception as e:
+                        logger.exception('Step %i shard %r-%r failed. (%r)', self.id, shard[0], shard[1], e)
+                        failed.append(shard)
+        finally:
+            self.release_lock()
+        return results, failed
 
     def get_next_step(self):
         next_step_exists = self.children.exists()
@@ -154,7 +365,10 @@ class Step(CTENode):
 
     #Modify method
     def step_move(self, subscriber):
-        return subscriber.move_to_step(self.id)
+        return subscriber.move_to_step(self)
+
+    def step_move_many(self, queryset):
+        return queryset.move_to_step(self.id)
 
 
 class Modify(models.Model):
@@ -184,6 +398,11 @@ class Modify(models.Model):
     def step_run(self, step, qs):
         method_name = self.get_method_name()
         content_object = self.content_object
+        # Prefer the queryset version of the method (e.g. 'step_move_many') if the content_object has one
+        many_method = getattr(content_object, '%s_many' % method_name, None)
+        if many_method:
+            many_method(queryset=qs)
+            return qs
         for subscriber in qs:
             method_call = getattr(content_object, method_name)(subscriber=subscriber)
         return qs
@@ -206,17 +425,55 @@ class Delay(models.Model):
     def __str__(self):
         return "Delay: %s" % self.duration
 
+    @classmethod
+    def get_due_at(cls, step, now):
+        """
+        When a subscriber moved onto step (a Step or a step id) at now is due to move on, or None if it isn't a
+        Delay step. Given a Step, only a Delay step costs a query.
+        """
+        if not step:
+            return None
+        content_type = ContentType.objects.get_for_model(cls)
+        if isinstance(step, Step):
+            delay_id = step.object_id if step.content_type_id == content_type.id else None
+        else:
+            # The step is looked up on its own, see StepManager.ids_for
+            delay_id = Step._base_manager.filter(id=step, content_type=content_type)\
+                .values_list('object_id', flat=True).first()
+        if delay_id is None:
+            return None
+        duration = cls.objects.filter(id=delay_id).values_list('duration', flat=True).first()
+        return now + duration if duration is not None else None
+
+    def get_due_subscribers(self, qs, now=None):
+        """
+        Subscribers whose due_at (step_timestamp + duration) is less than or equal to now.
+        Subscribers without a due_at fall back to step_timestamp <= now - duration.
+        """
+        now = now or timezone.now()
+        return qs.filter(
+            Q(due_at__lte=now) |
+            Q(due_at__isnull=True, step_timestamp__lte=now - self.duration)
+        )
+
+    def get_wake_at(self, step, qs, now):
+        # Subscribers with a due_at are found by StepManager.runnable, so this only has to
+        # cover the ones without one.
+        if not step.get_next_step():
+            return None
+        earliest = qs.filter(due_at__isnull=True).aggregate(earliest=models.Min('step_timestamp'))['earliest']
+        return earliest + self.duration if earliest else None
+
     def step_run(self, step, qs):
+        """
+        Moves every due subscriber to the next step in chunked UPDATEs.
+        Returns how many subscribers were moved.
+        """
         next_step = step.get_next_step()
+        if not next_step:
+            return 0
         now = timezone.now()
-        for subscriber in qs:
-            if next_step:
-                # goal_time = subscriber.step_timestamp + djangotimedelta.parse(self.delay)
-                goal_time = subscriber.step_timestamp + self.duration
-                # if goal time is greater than or equal to now, move on to the next step
-                if goal_time <= now:
-                    subscriber.move_to_step(next_step.id)
-        return qs
+        return self.get_due_subscribers(qs, now=now).move_to_step(next_step.id, now=now)
 
 
 class Decision(models.Model):
@@ -233,43 +490,35 @@ class Decision(models.Model):
     def __str__(self):
         return "Decision: %s" % self.description
 
-    def apply_queryset_rules(self, qs):
+    def apply_queryset_rules(self, qs, now=None):
         """
-        First collect all filter/exclude kwargs and apply any annotations.
-        Then apply all filters at once, and all excludes at once.
+        Applies the compiled (and cached) plan of this object's queryset rules.
+        See squeezemail.rules.RulePlan.apply
         """
-        clauses = {
-            'filter': [],
-            'exclude': []}
-
-        for rule in self.queryset_rules.all():
-
-            clause = clauses.get(rule.method_type, clauses['filter'])
-
-            kwargs = rule.filter_kwargs(qs)
-            clause.append(Q(**kwargs))
-
-            qs = rule.apply_any_annotation(qs)
-
-        if clauses['exclude']:
-            qs = qs.exclude(functools.reduce(operator.or_, clauses['exclude']))
-        qs = qs.filter(*clauses['filter'])
-        return qs
+        return get_rule_plan(self).apply(qs, now=now)
 
     def step_run(self, step, qs):
+        """
+        Moves the subscribers matching the rules to on_true and the rest to on_false, in chunked UPDATEs.
+        Both branches get the same step_timestamp.
+        Returns how many subscribers went down each branch.
+        """
+        now = timezone.now()
+        counts = {'true': 0, 'false': 0}
 
         qs_true = self.apply_queryset_rules(qs).distinct()
+        qs_false = qs.exclude(id__in=qs_true.values('id'))
 
-        true_ids = qs_true.values_list('id', flat=True)
-        qs_false = qs.exclude(id__in=true_ids)
         if self.on_true_id:
-            for subscriber in qs_true:
-                subscriber.move_to_step(self.on_true_id)
+            counts['true'] = qs_true.move_to_step(self.on_true_id, now=now)
 
+        # Subscribers that went down the true branch have already left this step,
+        # so the complement is still everyone who didn't match the rules.
         if self.on_false_id:
-            for subscriber in qs_false:
-                subscriber.move_to_step(self.on_false_id)
-        return qs
+            counts['false'] = qs_false.move_to_step(self.on_false_id, now=now)
+
+        logger.debug('Decision %i moved %i subscribers to on_true and %i to on_false', self.id, counts['true'], counts['false'])
+        return counts
 
 
 class EmailActivity(models.Model):
@@ -299,21 +548,26 @@ class EmailActivity(models.Model):
             qs_true = qs.filter(send_drips__id=opened_senddrip_id_list)
             true_ids = qs_true.values_list('id', flat=True)
 
-        if self.on_true_id:
-            for subscriber in qs_true:
-                subscriber.move_to_step(self.on_true_id)
+        now = timezone.now()
+        if self.on_true_id and qs_true is not False:
+            qs_true.move_to_step(self.on_true_id, now=now)
 
         if self.on_false_id:
             qs_false = qs.exclude(id__in=true_ids)
-            for subscriber in qs_false:
-                subscriber.move_to_step(self.on_false_id)
+            qs_false.move_to_step(self.on_false_id, now=now)
         return qs
 
 
+# Subject split test allocators this process has already built, keyed by drip id. See Drip.subject_allocator
+_subject_allocators = {}
+
+
 class DripSubject(models.Model):
     drip = models.ForeignKey('squeezemail.Drip', related_name='subjects')
     text = models.CharField(max_length=150)
     enabled = models.BooleanField(default=True)
+    weight = models.PositiveIntegerField(default=1, help_text="How often this subject is sent compared to the drip's "
+                                                              "other enabled subjects. 0 stops sending it.")
 
     def __str__(self):
         return self.text
@@ -327,9 +581,16 @@ class Drip(models.Model):
 
     regions = [
         Region(key='body', title='Main Body'),
-        # Region(key='split_test', title='Split Test Body',
-        #        inherited=False),
+        Region(key='split_test', title='Split Test Body',
+               inherited=False),
     ]
+    # Body split test variants: the name recorded on SendDrip.split (and passed around as sq_split), and the region
+    # it sends. 'main' is what every subscriber gets unless a variant's region has content, then they're split evenly.
+    MAIN_SPLIT = 'main'
+    BODY_SPLITS = (
+        (MAIN_SPLIT, 'body'),
+        ('split_test', 'split_test'),
+    )
     queryset_rules = GenericRelation(
         'squeezemail.QuerySetRule',
         content_type_field='content_type_id',
@@ -377,22 +638,61 @@ class Drip(models.Model):
     def split_subject_active(self):
         return self.get_split_test_subjects.count() > 1
 
+    @property
+    def subject_allocator(self):
+        """
+        Splits subscribers between the enabled subjects by their weights. The subjects are only loaded once per drip
+        per process, and again when Drip.lastchanged changes (saving or deleting a DripSubject touches it).
+        """
+        allocator = _subject_allocators.get(self.id)
+        if allocator is None or allocator.version != self.lastchanged:
+            subjects = list(self.subjects.filter(enabled=True).order_by('id'))
+            allocator = SplitAllocator(subjects, [subject.weight for subject in subjects], version=self.lastchanged)
+            if self.id:
+                _subject_allocators[self.id] = allocator
+        return allocator
+
+    def choose_subject(self, subscriber_id):
+        """
+        The DripSubject subscriber_id gets. Always the same one for the same subscriber (and the same subjects),
+        so it can be worked out again later, e.g. for stats.
+        """
+        return self.subject_allocator.choose('subject', self.id, subscriber_id)
+
     @cached_property
     def choose_split_test_subject(self):
-        # Return a subject object to be able to get the subject text and the subject id
-        random_subject = self.subjects.filter(enabled=True).order_by('?')[0]
-        return random_subject
+        # The most heavily weighted subject, for when there isn't a subscriber. Messages use choose_subject.
+        subjects = self.subject_allocator.variants
+        return max(subjects, key=lambda subject: subject.weight) if subjects else None
 
     def get_split_test_body(self):
-        pass
+        """
+        The content plugins of the main body and each body split test variant that has any, keyed by split name.
+        """
+        contents = contents_for_item(self, plugins=[Image, RichText])
+        return dict(
+            (split, contents[region]) for split, region in self.BODY_SPLITS
+            if split == self.MAIN_SPLIT or contents[region]
+        )
+
+    def split_test_stats(self):
+        """
+        How many were sent, opened and clicked per body split, e.g. {'main': {'sent': 10, 'opened': 4, 'clicked': 1}}.
+        Uses the (drip, split) index on SendDrip.
+        """
+        rows = SendDrip.objects.filter(drip_id=self.id, sent=True).values('split').annotate(
+            sent=models.Count('id'),
+            opened=models.Count('open'),
+            clicked=models.Count('click'),
+        )
+        return dict((row.pop('split'), row) for row in rows)
 
     def step_run(self, step, qs):
         not_received, have_received = self.split_received(qs)
         self.handler(step=step, queryset=not_received).step_run()
         next_step = step.get_next_step()
         if next_step:
-            for subscriber in have_received:
-                subscriber.move_to_step(next_step.id)
+            have_received.move_to_step(next_step.id)
         return qs
 
     def split_received(self, queryset):
@@ -404,28 +704,12 @@ class Drip(models.Model):
         have_received = queryset.filter(id__in=have_received_ids)
         return not_received, have_received
 
-    def apply_queryset_rules(self, qs):
+    def apply_queryset_rules(self, qs, now=None):
         """
-        First collect all filter/exclude kwargs and apply any annotations.
-        Then apply all filters at once, and all excludes at once.
+        Applies the compiled (and cached) plan of this object's queryset rules.
+        See squeezemail.rules.RulePlan.apply
         """
-        clauses = {
-            'filter': [],
-            'exclude': []}
-
-        for rule in self.queryset_rules.all():
-
-            clause = clauses.get(rule.method_type, clauses['filter'])
-
-            kwargs = rule.filter_kwargs(qs)
-            clause.append(Q(**kwargs))
-
-            qs = rule.apply_any_annotation(qs)
-
-        if clauses['exclude']:
-            qs = qs.exclude(functools.reduce(operator.or_, clauses['exclude']))
-        qs = qs.filter(*clauses['filter'])
-        return qs
+        return get_rule_plan(self).apply(qs, now=now)
 
     @cached_property
     def open_rate(self):
@@ -450,6 +734,92 @@ class Drip(models.Model):
         return (total_opened / total_clicked) * 100
 
 
+class SendDripManager(models.Manager):
+
+    def bulk_create_unsent(self, drip_id, subscriber_ids):
+        """
+        Creates an unsent SendDrip for each subscriber id that doesn't already have one for drip_id,
+        with one query to find the existing ones and one bulk INSERT for the rest.
+        Returns how many were created and how many already existed. Where the database can skip conflicting
+        rows, created is an upper bound: rows another worker inserted between the two queries are counted
+        as created, since the INSERT can't tell which of its rows it skipped.
+        """
+        subscriber_ids = set(subscriber_ids)
+        existing_ids = set(
+            self.filter(drip_id=drip_id, subscriber_id__in=subscriber_ids).values_list('subscriber_id', flat=True)
+        )
+        send_drips = [self.model(drip_id=drip_id, subscriber_id=subscriber_id, sent=False)
+                      for subscriber_id in subscriber_ids - existing_ids]
+        if not send_drips:
+            return 0, len(existing_ids)
+
+        if getattr(connection.features, 'supports_ignore_conflicts', False):
+            # Anything another worker created since we looked is silently skipped (and still counted, see above)
+            self.bulk_create(send_drips, ignore_conflicts=True)
+            return len(send_drips), len(existing_ids)
+
+        try:
+            with transaction.atomic():
+                self.bulk_create(send_drips)
+        except IntegrityError:
+            # Another worker created some of these since we looked, so fall back to one at a time for this chunk
+            created = 0
+            for send_drip in send_drips:
+                try:
+                    with transaction.atomic():
+                        send_drip.save()
+                    created += 1
+                except IntegrityError:
+                    pass
+            return created, len(subscriber_ids) - created
+        return len(send_drips), len(existing_ids)
+
+    def claimable(self, now=None):
+        """
+        Unsent SendDrips nobody is sending right now: never tried, failed, or claimed by a worker whose lease ran out.
+        """
+        now = now or timezone.now()
+        return self.filter(sent=False).filter(
+            Q(state__in=[self.model.UNSENT, self.model.FAILED]) |
+            Q(state=self.model.SENDING, lease_expires__lt=now)
+        )
+
+    def claim(self, drip_id, subscriber_ids, lease=None):
+        """
+        Atomically claims drip_id's claimable SendDrips for subscriber_ids, with one UPDATE. Two workers claiming the
+        same rows at once can't both get them (the second UPDATE re-checks the row after the first commits).
+        Returns the claim token and the claimed subscriber ids. The claim lasts lease seconds unless it's renewed.
+        """
+        token = uuid.uuid4().hex
+        now = timezone.now()
+        self.claimable(now).filter(drip_id=drip_id, subscriber_id__in=subscriber_ids).update(
+            state=self.model.SENDING,
+            claim=token,
+            lease_expires=now + timedelta(seconds=lease or SQUEEZE_SEND_LEASE)
+        )
+        claimed_ids = set(self.filter(claim=token, state=self.model.SENDING).values_list('subscriber_id', flat=True))
+        return token, claimed_ids
+
+    def renew_claim(self, token, lease=None):
+        """
+        Heartbeat: pushes back the lease on everything token still has claimed.
+        """
+        lease_expires = timezone.now() + timedelta(seconds=lease or SQUEEZE_SEND_LEASE)
+        return self.filter(claim=token, state=self.model.SENDING).update(lease_expires=lease_expires)
+
+    def mark_sent(self, token, subscriber_ids, now=None, split=None):
+        updates = {'sent': True, 'state': self.model.SENT, 'date': now or timezone.now(), 'lease_expires': None}
+        if split:
+            updates['split'] = split
+        return self.filter(claim=token, subscriber_id__in=subscriber_ids).update(**updates)
+
+    def release_claim(self, token):
+        """
+        Anything token claimed but didn't send is marked failed, so it can be claimed again.
+        """
+        return self.filter(claim=token, state=self.model.SENDING).update(state=self.model.FAILED, lease_expires=None)
+
+
 class SendDrip(models.Model):
     """
     Keeps a record of all sent drips.
@@ -458,13 +828,33 @@ class SendDrip(models.Model):
     This is done this way to save database space, since the majority of sentdrips won't even be opened, and to add extra
     data (such as timestamps) to filter off, so you could see your open rate for a drip within the past 24 hours.
     """
+    UNSENT = 'unsent'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATE_CHOICES = (
+        (UNSENT, 'Unsent'),
+        (SENDING, 'Sending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    )
+
     date = models.DateTimeField(auto_now_add=True)
     drip = models.ForeignKey('squeezemail.Drip', related_name='send_drips')
     subscriber = models.ForeignKey('squeezemail.Subscriber', related_name='send_drips')
     sent = models.BooleanField(default=False)
+    # A worker claims a SendDrip (state 'sending') before sending it, for SQUEEZE_SEND_LEASE seconds at a time.
+    state = models.CharField(max_length=10, choices=STATE_CHOICES, default=UNSENT, db_index=True, editable=False)
+    claim = models.CharField(max_length=32, null=True, blank=True, db_index=True, editable=False)
+    lease_expires = models.DateTimeField(null=True, blank=True, editable=False)
+    # Which body split test variant was sent (see Drip.BODY_SPLITS)
+    split = models.CharField(max_length=20, null=True, blank=True, editable=False)
+
+    objects = SendDripManager()
 
     class Meta:
         unique_together = ('drip', 'subscriber')
+        index_together = [('drip', 'split')]
 
     @property
     def opened(self):
@@ -483,6 +873,67 @@ class SendDrip(models.Model):
         return hasattr(self, 'unsubscribe')
 
 
+class BroadcastRun(models.Model):
+    """
+    One send of a broadcast Drip, with counters the send_drip tasks bump as they go, so it can be watched and resumed.
+    Counters only ever go up (through F() updates, see increment), so a resumed run keeps adding to the same totals.
+    """
+    drip = models.ForeignKey('squeezemail.Drip', related_name='broadcast_runs')
+    started = models.DateTimeField(default=timezone.now)
+    last_activity = models.DateTimeField(null=True, blank=True)
+    queued = models.PositiveIntegerField(default=0, help_text="Subscribers queued to celery, including resumes.")
+    claimed = models.PositiveIntegerField(default=0, help_text="Subscribers a worker started sending to.")
+    sent = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0, help_text="Claimed but not sent. They're retried on resume.")
+
+    class Meta:
+        ordering = ['-started']
+
+    def __str__(self):
+        return '%s (%s)' % (self.drip, self.started)
+
+    @classmethod
+    def increment(cls, run_id, **counts):
+        """
+        Atomically adds counts (e.g. sent=25) to run_id's counters, in one UPDATE.
+        """
+        updates = dict((field, models.F(field) + count) for field, count in counts.items() if count)
+        if not run_id or not updates:
+            return 0
+        return cls.objects.filter(id=run_id).update(last_activity=timezone.now(), **updates)
+
+    @property
+    def sent_per_minute(self):
+        minutes = ((self.last_activity or self.started) - self.started).total_seconds() / 60
+        return round(self.sent / minutes, 1) if minutes else 0.0
+
+    @property
+    def unsent(self):
+        return self.drip.send_drips.filter(sent=False).count()
+
+    def progress(self):
+        return {
+            'id': self.id,
+            'drip_id': self.drip_id,
+            'started': self.started.isoformat(),
+            'last_activity': self.last_activity.isoformat() if self.last_activity else None,
+            'queued': self.queued,
+            'claimed': self.claimed,
+            'sent': self.sent,
+            'failed': self.failed,
+            'unsent': self.unsent,
+            'sent_per_minute': self.sent_per_minute,
+        }
+
+    def resume(self):
+        """
+        Queues send_drip tasks for this run's drip's SendDrips that still aren't sent.
+        Ones a worker is still sending are skipped by the worker that picks them up (see SendDripManager.claim).
+        Returns how many chunks were queued.
+        """
+        return self.drip.handler().create_tasks_for_unsent_drips(broadcast_run_id=self.id)
+
+
 class Open(models.Model):
     senddrip = models.OneToOneField(SendDrip, primary_key=True)
     date = models.DateTimeField(auto_now_add=True)
@@ -533,47 +984,17 @@ class QuerySetRule(models.Model):
 
         return field_name
 
+    def compile(self):
+        """
+        Parses field_value once. See squeezemail.rules.CompiledRule
+        """
+        return CompiledRule.from_rule(self)
+
     def apply_any_annotation(self, qs):
-        if self.field_name.endswith('__count'):
-            field_name = self.annotated_field_name
-            agg, _, _ = self.field_name.rpartition('__')
-            qs = qs.annotate(**{field_name: models.Count(agg, distinct=True)})
-        return qs
+        return self.compile().apply_any_annotation(qs)
 
     def filter_kwargs(self, qs, now=timezone.now):
-        # Support Count() as m2m__count
-        field_name = self.annotated_field_name
-        field_name = '__'.join([field_name, self.lookup_type])
-        field_value = self.field_value
-
-        # set time deltas and dates
-        if self.field_value.startswith('now-'):
-            field_value = self.field_value.replace('now-', '')
-            field_value = now() - djangotimedelta.parse(field_value)
-        elif self.field_value.startswith('now+'):
-            field_value = self.field_value.replace('now+', '')
-            field_value = now() + djangotimedelta.parse(field_value)
-        elif self.field_value.startswith('today-'):
-            field_value = self.field_value.replace('today-', '')
-            field_value = now().date() - djangotimedelta.parse(field_value)
-        elif self.field_value.startswith('today+'):
-            field_value = self.field_value.replace('today+', '')
-            field_value = now().date() + djangotimedelta.parse(field_value)
-
-        # F expressions
-        if self.field_value.startswith('F_'):
-            field_value = self.field_value.replace('F_', '')
-            field_value = models.F(field_value)
-
-        # set booleans
-        if self.field_value == 'True':
-            field_value = True
-        if self.field_value == 'False':
-            field_value = False
-
-        kwargs = {field_name: field_value}
-
-        return kwargs
+        return self.compile().filter_kwargs(now())
 
     def apply(self, qs, now=timezone.now):
 
@@ -668,12 +1089,44 @@ class FunnelManager(models.Manager):
     pass
 
 
-class SubscriberManager(models.Manager):
+class SubscriberQuerySet(models.QuerySet):
+
+    def move_to_step(self, step_id, now=None, chunk_size=None):
+        """
+        Moves every subscriber in this queryset to step_id in chunked UPDATEs,
+        instead of a save() per subscriber. The ids are read first rather than updated
+        through a subquery, which MySQL doesn't allow on the table being updated.
+        Returns how many subscribers were moved.
+        """
+        subscriber_ids = self.values_list('id', flat=True).iterator()
+        return self.model.objects.move_ids_to_step(subscriber_ids, step_id, now=now, chunk_size=chunk_size)
+
+
+class SubscriberManager(models.Manager.from_queryset(SubscriberQuerySet)):
     """
     Custom manager for Subscriber to provide extra functionality
     """
     use_for_related_fields = True
 
+    def move_ids_to_step(self, subscriber_ids, step_id, now=None, chunk_size=None):
+        """
+        Sets step_id and step_timestamp for every subscriber id in subscriber_ids, chunk_size ids per UPDATE.
+        If anything is listening to subscribers_moved, it's sent once per chunk with the ids that were moved.
+        Returns how many subscribers were moved.
+        """
+        now = now or timezone.now()
+        chunk_size = chunk_size or SQUEEZE_STEP_MOVE_CHUNK_SIZE
+        due_at = Delay.get_due_at(step_id, now)
+        send_signal = subscribers_moved.has_listeners(self.model)
+        moved = 0
+        for chunk in chunked(subscriber_ids, chunk_size):
+            moved += self.model._base_manager.filter(id__in=chunk).update(step=step_id, step_timestamp=now, due_at=due_at)
+            if send_signal:
+                subscribers_moved.send(sender=self.model, step_id=step_id, subscriber_ids=chunk, timestamp=now)
+        if moved and step_id:
+            Step.objects.mark_dirty([step_id])
+        return moved
+
     def get_or_add(self, email, *args, **kwargs):
         try:
             #Try to get existing subscriber
@@ -707,20 +1160,35 @@ class Subscriber(models.Model):
     created = models.DateTimeField(default=timezone.now)
     step = models.ForeignKey('squeezemail.Step', related_name="subscribers", blank=True, null=True)
     step_timestamp = models.DateTimeField(verbose_name="Last Step Activity Timestamp", blank=True, null=True)
+    due_at = models.DateTimeField(blank=True, null=True, db_index=True, editable=False, help_text="When the subscriber is due to move on from the Delay step they're on.")
 
     objects = subscriber_manager
     default_manager = subscriber_manager
 
+    def __init__(self, *args, **kwargs):
+        super(Subscriber, self).__init__(*args, **kwargs)
+        # The step and is_active as they were last saved. See mark_subscriber_steps_dirty
+        self._saved_step_state = self.get_step_state()
+
     def __str__(self):
         return self.email
 
+    def get_step_state(self):
+        # Fields left out with only()/defer() aren't loaded just for this
+        return self.__dict__.get('step_id'), self.__dict__.get('is_active')
+
     def get_email(self):
         return self.user.email if self.user_id else self.email
 
-    def move_to_step(self, step_id):
-        self.step_id = step_id
+    def move_to_step(self, step):
+        """
+        Moves this subscriber onto step, a Step or a step id. Passing the Step saves looking it up to see whether
+        it's a Delay. Saving marks the step dirty (see mark_subscriber_steps_dirty).
+        """
+        self.step_id = getattr(step, 'id', step)
         self.step_timestamp = timezone.now()
-        self.save()
+        self.due_at = Delay.get_due_at(step, self.step_timestamp)
+        self.save(update_fields=['step', 'step_timestamp', 'due_at'])
         return
 
     def unsubscribe(self):
@@ -782,6 +1250,55 @@ class FunnelSubscription(models.Model):
 #     last_send_drip = models.ForeignKey('squeezemail.SendDrip', null=True, blank=True)
 
 
+@receiver([post_save, post_delete], sender=QuerySetRule)
+def expire_queryset_rule_plan(sender, instance, **kwargs):
+    # Drip/Decision rule plans are cached, so throw away the one this rule belongs to
+    expire_rule_plan(instance.content_type_id, instance.object_id)
+    mark_steps_dirty_for(instance.content_type_id, instance.object_id)
+
+
+def mark_steps_dirty_for(content_type_id, object_id):
+    return Step.objects.mark_dirty(Step.objects.ids_for(content_type_id, object_id))
+
+
+@receiver([post_save, post_delete], sender=DripSubject)
+def touch_subject_drip(sender, instance, **kwargs):
+    # Drips' subject allocators are cached until the drip's lastchanged changes
+    Drip.objects.filter(id=instance.drip_id).update(lastchanged=timezone.now())
+
+
+@receiver(post_save, sender=Subscriber)
+def mark_subscriber_steps_dirty(sender, instance, created=False, **kwargs):
+    # Steps only run when something happened (see StepManager.runnable), so a subscriber that's added, moved or
+    # (de)activated with a plain save(), e.g. in the admin, has to mark the steps they left and joined dirty.
+    state = instance.get_step_state()
+    if created or state != instance._saved_step_state:
+        step_ids = set([instance._saved_step_state[0], state[0]]) - set([None])
+        if step_ids:
+            Step.objects.mark_dirty(step_ids)
+    instance._saved_step_state = state
+
+
+@receiver(post_save, sender=Delay)
+def update_delay_due_at(sender, instance, created=False, **kwargs):
+    # The duration may have changed, so work out when everyone waiting on it is due again
+    if created:
+        return
+    step_ids = Step.objects.ids_for(ContentType.objects.get_for_model(Delay).id, instance.pk)
+    if step_ids:
+        Subscriber.objects.filter(step__in=step_ids).update(due_at=models.F('step_timestamp') + instance.duration)
+
+
+@receiver(post_save, sender=Delay)
+@receiver(post_save, sender=Decision)
+@receiver(post_save, sender=Drip)
+@receiver(post_save, sender=Modify)
+@receiver(post_save, sender=EmailActivity)
+def mark_content_object_steps_dirty(sender, instance, **kwargs):
+    # A step's delay/decision/drip changed, so the steps using it have to run again
+    mark_steps_dirty_for(ContentType.objects.get_for_model(instance).id, instance.pk)
+
+
 DripPlugin = create_plugin_base(Drip)
 
 
@@ -0,0 +1,230 @@
+import logging
+import multiprocessing
+import uuid
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from email import quoprimime
+from email.header import Header
+from email.utils import formatdate, make_msgid
+
+from django.conf import settings
+from django.core.mail import EmailMessage, BadHeaderError
+from django.core.mail.message import sanitize_address
+from django.core.mail.utils import DNS_NAME
+from django.db import connection, connections
+
+from squeezemail import SQUEEZE_RENDER_POOL_SIZE, SQUEEZE_RENDER_POOL, SQUEEZE_PRESERIALIZE_MIME
+from squeezemail.connections import sends_raw_messages
+from squeezemail.utils import chunked
+
+logger = logging.getLogger(__name__)
+
+# How many messages each render pool task renders. Big enough to keep pickling/queueing overhead low,
+# small enough that the sending loop gets its first messages quickly.
+RENDER_BATCH_SIZE = 20
+
+
+class RawMIME(object):
+    """
+    Stands in for the email.message.Message an EmailMessage's message() returns, for an already serialized message.
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def as_bytes(self, linesep='\r\n', **kwargs):
+        return self.raw
+
+    def as_string(self, **kwargs):
+        return self.raw.decode('utf-8')
+
+
+class RawEmailMessage(EmailMessage):
+    """
+    A message that's already serialized to bytes (with CRLF line endings). Backends that send message().as_bytes(),
+    like Django's SMTP backend and the async engine, send those bytes as they are.
+    """
+
+    def __init__(self, raw, from_email, to, encoding=None, **kwargs):
+        super(RawEmailMessage, self).__init__('', '', from_email, to, **kwargs)
+        self.raw = raw
+        self.encoding = encoding
+
+    def message(self):
+        return RawMIME(self.raw)
+
+
+class MimeSkeleton(object):
+    """
+    The bytes of a drip email (multipart/alternative, plain text and html) that are the same for every subscriber:
+    the From header, the boundary and each part's headers. assemble() splices one subscriber's subject, To, date,
+    message id and bodies in between them with a single join, instead of building an email.message tree and
+    serializing it with the email package. Bodies are always quoted-printable.
+    """
+
+    def __init__(self, from_email, encoding=None):
+        self.from_email = from_email
+        self.encoding = encoding or settings.DEFAULT_CHARSET
+        # quoted-printable never has '==' in it, so this can't turn up in a body
+        boundary = '===============%s==' % uuid.uuid4().hex
+        self.head = (
+            'Content-Type: multipart/alternative;\r\n boundary="%s"\r\n'
+            'MIME-Version: 1.0\r\n'
+            'From: %s\r\n' % (boundary, sanitize_address(from_email, self.encoding))
+        ).encode('ascii')
+        part = (
+            '--%s\r\n'
+            'Content-Type: text/%%s; charset="%s"\r\n'
+            'MIME-Version: 1.0\r\n'
+            'Content-Transfer-Encoding: quoted-printable\r\n\r\n' % (boundary, self.encoding)
+        )
+        self.plain_part = (part % 'plain').encode('ascii')
+        self.html_part = (b'\r\n' + (part % 'html').encode('ascii'))
+        self.end = ('\r\n--%s--\r\n' % boundary).encode('ascii')
+
+    def encode_header(self, name, value):
+        if '\n' in value or '\r' in value:
+            raise BadHeaderError("Header values can't contain newlines (got %r for header %r)" % (value, name))
+        try:
+            value.encode('ascii')
+            charset = 'us-ascii'
+        except UnicodeEncodeError:
+            charset = self.encoding
+        return Header(value, charset, header_name=name).encode(linesep='\r\n').encode('ascii')
+
+    def encode_body(self, text):
+        return quoprimime.body_encode(text.encode(self.encoding).decode('latin-1'), eol='\r\n').encode('ascii')
+
+    def assemble(self, to, subject, plain, html):
+        """
+        Returns the RawEmailMessage to send to the address to.
+        """
+        raw = b''.join((
+            self.head,
+            b'Subject: ', self.encode_header('Subject', subject),
+            b'\r\nTo: ', sanitize_address(to, self.encoding).encode('ascii'),
+            b'\r\nDate: ', formatdate(localtime=getattr(settings, 'EMAIL_USE_LOCALTIME', False)).encode('ascii'),
+            b'\r\nMessage-ID: ', make_msgid(domain=str(DNS_NAME)).encode('ascii'),
+            b'\r\n\r\n',
+            self.plain_part, self.encode_body(plain),
+            self.html_part, self.encode_body(html),
+            self.end,
+        ))
+        return RawEmailMessage(raw, self.from_email, [to], encoding=self.encoding)
+
+
+class RenderedMessage(object):
+    """
+    A rendered DripMessage, with just what send_drip needs: the subscriber, the subject, the body split it got,
+    and the message ready to send.
+    """
+
+    def __init__(self, subscriber, subject, message, split=None):
+        self.subscriber = subscriber
+        self.subject = subject
+        self.message = message
+        self.split = split
+
+
+def serialize_message(message):
+    """
+    Renders and serializes message (any Django EmailMessage) to a RawEmailMessage.
+    """
+    raw = message.message().as_bytes(linesep='\r\n')
+    return RawEmailMessage(raw, message.from_email, message.recipients(), encoding=message.encoding)
+
+
+def sendable_message(message_instance, raw=None):
+    """
+    The email to send for message_instance (a DripMessage): its raw_message if SQUEEZE_PRESERIALIZE_MIME is on, it
+    has one and raw messages can be sent (see squeezemail.connections.sends_raw_messages), otherwise its message.
+    """
+    if raw is None:
+        raw = sends_raw_messages()
+    if raw and SQUEEZE_PRESERIALIZE_MIME and hasattr(message_instance, 'raw_message'):
+        return message_instance.raw_message
+    return message_instance.message
+
+
+def render_message(MessageClass, drip, send_context, subscriber, serialize=True):
+    """
+    Returns subscriber's RenderedMessage, or None if it couldn't be rendered.
+    With serialize, its message is a RawEmailMessage. Otherwise it's the message with everything already rendered.
+    """
+    try:
+        message_instance = MessageClass(drip, subscriber, send_context=send_context)
+        message = sendable_message(message_instance, raw=serialize)
+        if serialize and not isinstance(message, RawEmailMessage):
+            message = serialize_message(message)
+        elif not serialize and hasattr(message, 'render'):
+            # e.g. a LazyEmailMultiAlternatives
+            message.render()
+        return RenderedMessage(subscriber, message_instance.subject, message, getattr(message_instance, 'split', None))
+    except Exception as e:
+        logger.warning("Failed to render email message to %i. (%r)", subscriber.id, e)
+        return None
+
+
+def render_batch(MessageClass, drip, send_context, subscribers, serialize=True):
+    try:
+        return [render_message(MessageClass, drip, send_context, subscriber, serialize) for subscriber in subscribers]
+    finally:
+        # every pool thread/process gets its own database connection
+        connection.close()
+
+
+class RenderPool(object):
+    """
+    Renders and serializes messages on a pool of threads or processes (SQUEEZE_RENDER_POOL), so the sending loop only
+    has bytes to push. A size of 0 renders inline.
+    Messages are only serialized when serialize is on, which by default is when they're sent straight to an SMTP
+    server (see squeezemail.connections.sends_raw_messages). Otherwise they're just rendered.
+    Processes get around the GIL, but can't be started from celery's default prefork workers (they're daemons), so
+    they're for workers started with --pool=threads/solo/gevent, and for the benchmark_render command.
+    """
+
+    def __init__(self, size=None, kind=None, serialize=None):
+        self.size = SQUEEZE_RENDER_POOL_SIZE if size is None else size
+        self.kind = kind or SQUEEZE_RENDER_POOL
+        self.serialize = sends_raw_messages() if serialize is None else serialize
+
+    def process_executor(self):
+        # Forked, so the workers start with Django already set up
+        try:
+            return ProcessPoolExecutor(max_workers=self.size, mp_context=multiprocessing.get_context('fork'))
+        except (AttributeError, TypeError):  # Python < 3.7
+            return ProcessPoolExecutor(max_workers=self.size)
+
+    def render(self, MessageClass, drip, send_context, subscribers):
+        """
+        Yields a RenderedMessage for each subscriber that could be rendered, in order.
+        """
+        # Loaded once here, instead of once in every thread/process
+        drip.subject_allocator
+
+        if self.size <= 0:
+            for subscriber in subscribers:
+                rendered = render_message(MessageClass, drip, send_context, subscriber, self.serialize)
+                if rendered is not None:
+                    yield rendered
+            return
+
+        if self.kind == 'process':
+            # Forked processes mustn't share the parent's database connections. It'll reconnect when it needs to.
+            connections.close_all()
+            executor = self.process_executor()
+        else:
+            executor = ThreadPoolExecutor(max_workers=self.size)
+
+        with executor:
+            batches = [
+                executor.submit(render_batch, MessageClass, drip, send_context, batch, self.serialize)
+                for batch in chunked(subscribers, RENDER_BATCH_SIZE)
+            ]
+            try:
+                for batch in batches:
+                    for rendered in batch.result():
+                        if rendered is not None:
+                            yield rendered
+            finally:
+                for batch in batches:
+                    batch.cancel()
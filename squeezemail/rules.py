@@ -0,0 +1,178 @@
+import functools
+import operator
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import models
+from django.db.models import Q
+from django.utils import timezone
+
+# just using this to parse, but totally insane package naming...
+# https://bitbucket.org/schinckel/django-timedelta-field/
+import timedelta as djangotimedelta
+
+from squeezemail import SQUEEZE_PREFIX, SQUEEZE_RULE_PLAN_CACHE_TIMEOUT
+
+
+# field_value prefix, the anchor it's relative to, and which way the timedelta goes
+RELATIVE_PREFIXES = (
+    ('now-', 'now', -1),
+    ('now+', 'now', 1),
+    ('today-', 'today', -1),
+    ('today+', 'today', 1),
+)
+
+# Plans this process has already compiled, keyed by their cache key.
+_local_plans = {}
+
+
+class CompiledRule(object):
+    """
+    A QuerySetRule with its field_value already parsed.
+    Relative values ('now-7 days', 'today+1 day') are stored as an anchor and a timedelta,
+    so only 'now' has to be bound each time the rule is applied.
+    """
+
+    def __init__(self, method_type, lookup, value, anchor=None, aggregate=None, annotated_field_name=None):
+        self.method_type = method_type
+        self.lookup = lookup
+        self.value = value
+        self.anchor = anchor
+        self.aggregate = aggregate
+        self.annotated_field_name = annotated_field_name
+
+    @classmethod
+    def from_rule(cls, rule):
+        field_value = rule.field_value
+        value = field_value
+        anchor = None
+
+        # set time deltas and dates
+        for prefix, prefix_anchor, sign in RELATIVE_PREFIXES:
+            if field_value.startswith(prefix):
+                anchor = prefix_anchor
+                value = djangotimedelta.parse(field_value.replace(prefix, '')) * sign
+                break
+
+        # F expressions
+        if field_value.startswith('F_'):
+            value = models.F(field_value.replace('F_', ''))
+
+        # set booleans
+        if field_value == 'True':
+            value = True
+        if field_value == 'False':
+            value = False
+
+        # Support Count() as m2m__count
+        aggregate = None
+        if rule.field_name.endswith('__count'):
+            aggregate, _, _ = rule.field_name.rpartition('__')
+
+        annotated_field_name = rule.annotated_field_name
+        return cls(
+            method_type=rule.method_type,
+            lookup='__'.join([annotated_field_name, rule.lookup_type]),
+            value=value,
+            anchor=anchor,
+            aggregate=aggregate,
+            annotated_field_name=annotated_field_name,
+        )
+
+    def bind_value(self, now):
+        if self.anchor == 'now':
+            return now + self.value
+        if self.anchor == 'today':
+            return now.date() + self.value
+        return self.value
+
+    def filter_kwargs(self, now):
+        return {self.lookup: self.bind_value(now)}
+
+    def apply_any_annotation(self, qs):
+        if self.aggregate:
+            qs = qs.annotate(**{self.annotated_field_name: models.Count(self.aggregate, distinct=True)})
+        return qs
+
+
+class RulePlan(object):
+    """
+    Every QuerySetRule of a Drip/Decision, compiled and ready to be applied to a queryset.
+    version changes whenever a rule is added, changed or deleted.
+    """
+
+    def __init__(self, rules, version):
+        self.rules = [CompiledRule.from_rule(rule) for rule in rules]
+        self.version = version
+
+    @staticmethod
+    def get_version(rules):
+        """
+        The version of a queryset of rules: their newest lastchanged and how many there are, read from the database
+        with one aggregate query.
+        """
+        stats = rules.aggregate(lastchanged=models.Max('lastchanged'), count=models.Count('id'))
+        lastchanged = stats['lastchanged']
+        return '%s-%i' % (lastchanged.isoformat() if lastchanged else '', stats['count'])
+
+    def apply(self, qs, now=None):
+        """
+        First collect all filter/exclude kwargs and apply any annotations.
+        Then apply all filters at once, and all excludes at once.
+        """
+        now = now or timezone.now()
+        clauses = {
+            'filter': [],
+            'exclude': []}
+
+        for rule in self.rules:
+
+            clause = clauses.get(rule.method_type, clauses['filter'])
+
+            clause.append(Q(**rule.filter_kwargs(now)))
+
+            qs = rule.apply_any_annotation(qs)
+
+        if clauses['exclude']:
+            qs = qs.exclude(functools.reduce(operator.or_, clauses['exclude']))
+        qs = qs.filter(*clauses['filter'])
+        return qs
+
+
+def rule_plan_cache_key(content_type_id, object_id):
+    return '%sruleplan-%s-%s' % (SQUEEZE_PREFIX, content_type_id, object_id)
+
+
+def get_rule_plan(obj):
+    """
+    Returns the compiled RulePlan of obj's queryset_rules (obj is a Drip or Decision).
+    Plans are kept in memory and in Django's cache, and are only used while their version matches the rules in the
+    database (one aggregate query per call). So a plan cached late from rules that have since changed is never used,
+    and rules changed with .update() are picked up as long as it sets lastchanged.
+    """
+    content_type_id = ContentType.objects.get_for_model(obj).id
+    plan_key = rule_plan_cache_key(content_type_id, obj.pk)
+    rules = obj.queryset_rules.all()
+    version = RulePlan.get_version(rules)
+
+    plan = _local_plans.get(plan_key)
+    if plan is not None and plan.version == version:
+        return plan
+    plan = cache.get(plan_key)
+    if plan is not None and plan.version == version:
+        _local_plans[plan_key] = plan
+        return plan
+
+    plan = RulePlan(rules, version)
+    cache.set(plan_key, plan, SQUEEZE_RULE_PLAN_CACHE_TIMEOUT)
+    _local_plans[plan_key] = plan
+    return plan
+
+
+def expire_rule_plan(content_type_id, object_id):
+    """
+    Throws away a plan that's out of date anyway, so it doesn't sit in the cache until it times out.
+    """
+    plan_key = rule_plan_cache_key(content_type_id, object_id)
+    cache.delete(plan_key)
+    _local_plans.pop(plan_key, None)
@@ -0,0 +1,6 @@
+from django.dispatch import Signal
+
+
+# Sent once per chunk when subscribers are moved to a step in bulk (see SubscriberQuerySet.move_to_step).
+# sender is the Subscriber model, subscriber_ids is the list of ids that were moved in that chunk.
+subscribers_moved = Signal(providing_args=['step_id', 'subscriber_ids', 'timestamp'])
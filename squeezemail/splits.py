@@ -0,0 +1,42 @@
+import hashlib
+from bisect import bisect_right
+
+
+def bucket(*keys):
+    """
+    A number in [0, 1) worked out by hashing keys, e.g. ('subject', drip_id, subscriber_id).
+    The same keys always give the same number, in every process, so a split test allocation can be reproduced later.
+    """
+    digest = hashlib.md5(':'.join(str(key) for key in keys).encode('utf-8')).hexdigest()
+    return int(digest[:13], 16) / float(16 ** 13)
+
+
+class SplitAllocator(object):
+    """
+    Deterministically assigns one of variants to each key, in proportion to weights (all equal if not given).
+    variants have to be in a stable order (e.g. by id), or the same key could get a different variant.
+    Adding, removing or reweighting a variant moves some keys to another one.
+    """
+
+    def __init__(self, variants, weights=None, version=None):
+        self.variants = list(variants)
+        weights = list(weights) if weights is not None else [1] * len(self.variants)
+        if not any(weights):
+            weights = [1] * len(self.variants)
+        self.version = version
+        # each variant's upper bound in [0, 1)
+        total = float(sum(weights))
+        self.bounds = []
+        running = 0
+        for weight in weights:
+            running += weight
+            self.bounds.append(running / total)
+
+    def choose(self, *keys):
+        """
+        The variant for keys, or None if there aren't any variants.
+        """
+        if not self.variants:
+            return None
+        index = bisect_right(self.bounds, bucket(*keys))
+        return self.variants[min(index, len(self.variants) - 1)]
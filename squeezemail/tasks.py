@@ -1,127 +1,341 @@
-from hashlib import md5
+import threading
+import time
 
-from celery import shared_task, task
-from django.conf import settings
+from celery import shared_task, task, group, chord
+from celery.backends.base import DisabledBackend
+from celery.signals import worker_process_shutdown
 from django.contrib.auth import get_user_model
-from django.core.exceptions import ObjectDoesNotExist
-from django.core.mail import get_connection
-from django.core.cache import cache
+from django.db import connection
 from django.utils import timezone
 
 from google_analytics_reporter.tracking import Event
 
-from squeezemail import SQUEEZE_PREFIX
-from .models import SendDrip, Drip, Subscriber, Open, Click, DripSubject, Step, Unsubscribe
+from squeezemail import SQUEEZE_STEP_QUEUE, SQUEEZE_STEP_SHARD_SIZE, SQUEEZE_SEND_CHECKPOINT_SIZE
+from squeezemail import SQUEEZE_SEND_LEASE
+from .connections import batch_sender, close_connection_pools, sends_raw_messages
+from .rendering import RenderPool, sendable_message
+from .models import BroadcastRun, SendDrip, Drip, Subscriber, Open, Click, DripSubject, Step, Unsubscribe
 
-LOCK_EXPIRE = (60 * 60) * 24  # Lock expires in 24 hours if it never gets unlocked
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+
+def get_step_task_options():
+    return {'queue': SQUEEZE_STEP_QUEUE} if SQUEEZE_STEP_QUEUE else {}
+
+
+def get_step_tasks(run_all=False, shard_size=None):
+    """
+    A celery group of one run_step task per runnable Step (see StepManager.runnable), routed to
+    SQUEEZE_STEP_QUEUE if it's set. run_all=True queues every active step instead.
+    shard_size overrides SQUEEZE_STEP_SHARD_SIZE for these tasks.
+    """
+    options = get_step_task_options()
+    steps = Step.objects.filter(is_active=True) if run_all else Step.objects.runnable()
+    step_id_list = steps.values_list('id', flat=True)
+    kwargs = {'shard_size': shard_size} if shard_size else {}
+    return group([run_step.s(step_id, **kwargs).set(**options) for step_id in step_id_list])
 
 
 @task()
 def run_steps():
     """
-    Runs through all the active Steps, moving subscribers around, sending drips, tagging, etc.
-    Recommended to have 1 worker on this for now until locking is working properly.
+    Runs through all the active Steps that have something to do, moving subscribers around, sending drips, tagging, etc.
+    Each step is queued as its own run_step task, so a tick is spread over every worker listening to the step queue.
+    Step.acquire_lock makes sure a step is only ever run by one worker at a time.
+    If there's a result backend, the step results are gathered by gather_step_results.
     """
-    for step in Step.objects.filter(is_active=True):
-        step.run()
-    return
+    step_tasks = get_step_tasks()
+    if not step_tasks.tasks:
+        return 0
+    if isinstance(run_step.backend, DisabledBackend):
+        step_tasks.apply_async()
+    else:
+        chord(step_tasks)(gather_step_results.s())
+    return len(step_tasks.tasks)
 
 
-@task(bind=True)
-def send_drip(self, subscriber_id_list, backend_kwargs=None, **kwargs):
+@task()
+def run_step(step_id, shard_size=None):
     """
-    Used to send drips to massive lists (100k+). Sending a broadcast uses this.
+    Runs a single Step. Returns the step id and the step's result if it can be serialized (e.g. a moved count).
+    Steps with more than shard_size (SQUEEZE_STEP_SHARD_SIZE) active subscribers are split into id ranges instead,
+    and a run_step_shard task is queued for each range.
     """
-    next_step_id = kwargs.get('next_step_id', None)
-    drip_id = kwargs['drip_id']
-    first_subscriber_id = subscriber_id_list[0]
-
-    # The cache key consists of the squeeze_prefix (if it exists), drip id, first user id in the list and the MD5 digest.
-    # This is to prevent a subscriber receiving 1 email multiple times if 2+ identical tasks are queued. The workers tend
-    # to be so fast, that I've tested it without this and a subscriber was able to receive 1 email ~10 times when a bunch of
-    # identical stale tasks were sitting in the queue waiting for celery to start.
-    # Adding in the first_subscriber_id stops this from happening. Haven't figured out a better way yet.
-    drip_id_hexdigest = md5(str(SQUEEZE_PREFIX).encode('utf-8') + str(drip_id).encode('utf-8') + '_'.encode('utf-8') + str(first_subscriber_id).encode('utf-8')).hexdigest()
-    lock_id = '{0}-lock-{1}'.format(self.name, drip_id_hexdigest)
-
-    # cache.add fails if the key already exists
-    acquire_lock = lambda: cache.add(lock_id, 'true', LOCK_EXPIRE)
-    # memcache delete is very slow, but we have to use it to take
-    # advantage of using add() for atomic locking
-    release_lock = lambda: cache.delete(lock_id)
-
-    logger.debug('Attempting to aquire lock for drip_id %i', drip_id)
-    if acquire_lock():
-        messages_sent = 0
+    shard_size = shard_size or SQUEEZE_STEP_SHARD_SIZE
+    try:
+        step = Step.objects.get(id=step_id, is_active=True)
+    except Step.DoesNotExist:
+        logger.warning("Step %i doesn't exist or isn't active", step_id)
+        return
+    if step.shards_running():
+        logger.debug("Step %i shards from a previous run are still running", step_id)
+        return
+    if shard_size and step.get_active_subscribers_count() > shard_size:
+        # Held while the shards are handed out, so the step can't also be run whole (Step.run skips a step
+        # while its shards are running).
+        if not step.acquire_lock():
+            logger.debug("Step %i is already running", step_id)
+            return
         try:
-            from squeezemail.handlers import message_class_for
-            # backward compat: handle **kwargs and missing backend_kwargs
-            combined_kwargs = {}
-            if backend_kwargs is not None:
-                combined_kwargs.update(backend_kwargs)
-            combined_kwargs.update(kwargs)
+            options = get_step_task_options()
+            shards = step.get_shard_ranges(shard_size)
+            if not step.acquire_shards_lock(len(shards)):
+                return
+            step.mark_clean()
+            group([run_step_shard.s(step_id, min_id, max_id).set(**options) for min_id, max_id in shards]).apply_async()
+        finally:
+            step.release_lock()
+        return {'step_id': step_id, 'shards': len(shards)}
+    result = step.run()
+    return {
+        'step_id': step_id,
+        'result': result if isinstance(result, (int, dict)) else None,
+    }
+
 
+@task(bind=True, max_retries=3, default_retry_delay=60)
+def run_step_shard(self, step_id, min_id=None, max_id=None):
+    """
+    Runs one subscriber id range of a Step. A failing shard is retried on its own.
+    """
+    try:
+        step = Step.objects.get(id=step_id)
+    except Step.DoesNotExist:
+        logger.warning("Step %i doesn't exist", step_id)
+        return
+    step.touch_shards_lock()
+    try:
+        result = step.run_shard(min_id, max_id)
+    except Exception as e:
+        if self.request.retries >= self.max_retries:
+            logger.exception("Step %i shard %r-%r failed. (%r)", step_id, min_id, max_id, e)
+            step.release_shard()
+            raise
+        logger.warning("Step %i shard %r-%r failed, retrying. (%r)", step_id, min_id, max_id, e)
+        raise self.retry(exc=e)
+    step.release_shard()
+    return {
+        'step_id': step_id,
+        'shard': [min_id, max_id],
+        'result': result if isinstance(result, (int, dict)) else None,
+    }
+
+
+@task()
+def gather_step_results(results):
+    """
+    Chord callback of run_steps. Logs how many of the queued steps actually ran.
+    """
+    ran = [result for result in results if result]
+    logger.info("Ran %i of %i queued steps", len(ran), len(results))
+    return ran
+
+
+def record_sent_drips(claim, sent_splits, next_step_id=None, broadcast_run_id=None):
+    """
+    Marks the claimed SendDrips of sent_splits ({subscriber_id: body split sent}) as sent, renews the rest of the
+    claim, and moves the subscribers to next_step_id, in bulk (one UPDATE per split).
+    """
+    if not sent_splits:
+        return
+    now = timezone.now()
+    subscriber_id_list = list(sent_splits)
+    by_split = {}
+    for subscriber_id, split in sent_splits.items():
+        by_split.setdefault(split, []).append(subscriber_id)
+    for split, split_ids in by_split.items():
+        SendDrip.objects.mark_sent(claim, split_ids, now=now, split=split)
+    SendDrip.objects.renew_claim(claim)
+    BroadcastRun.increment(broadcast_run_id, sent=len(subscriber_id_list))
+    # Move subscribers to next step only after their drip has been sent
+    if next_step_id:
+        Subscriber.objects.move_ids_to_step(subscriber_id_list, next_step_id, now=now)
+
+
+class RenderFailed(object):
+    """
+    Put on the rendered queue in place of the final None when render_messages dies, so the consumer re-raises error.
+    """
+
+    def __init__(self, error):
+        self.error = error
+
+
+def render_messages(MessageClass, drip, subscribers, rendered, stop, send_context=None):
+    """
+    Producer half of send_drip's window mode. Renders each subscriber's message onto the rendered queue
+    as (subscriber, message_instance), then puts None, or a RenderFailed if rendering raised.
+    Stops early when the consumer sets stop.
+    Messages are rendered, and serialized to bytes when they're sent straight to an SMTP server, by a RenderPool
+    (see SQUEEZE_RENDER_POOL_SIZE), so all the sending side has left to do is push them to the server.
+    """
+    def put(item):
+        while not stop.is_set():
             try:
-                drip = Drip.objects.get(id=drip_id)
-                MessageClass = message_class_for(drip.message_class)
-            except Drip.DoesNotExist:
-                logger.warning("Drip %i doesn't exist" % drip_id)
+                rendered.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    end = None
+    try:
+        for message_instance in RenderPool().render(MessageClass, drip, send_context, subscribers):
+            if not put((message_instance.subscriber, message_instance)):
                 return
+    except BaseException as e:
+        end = RenderFailed(e)
+    finally:
+        # always put the end marker, or the consumer would wait on the queue forever
+        put(end)
+        # this thread got its own database connection
+        connection.close()
 
-            conn = get_connection(backend=settings.EMAIL_BACKEND, **combined_kwargs)
+
+def get_rendered(rendered, renderer):
+    """
+    The next item render_messages put on the rendered queue. Raises if renderer died without putting its end marker.
+    """
+    while True:
+        try:
+            return rendered.get(timeout=1)
+        except queue.Empty:
+            if renderer.is_alive():
+                continue
             try:
-                conn.open()
+                # it may have put its last item just before it finished
+                return rendered.get_nowait()
+            except queue.Empty:
+                raise RuntimeError('The render thread stopped without finishing')
+
+
+def send_rendered_messages(send_batch, MessageClass, drip, subscribers, window_size=1, send_context=None):
+    """
+    Yields (subscriber, message_instance, sent) for each subscriber, sending with send_batch (see batch_sender).
+    With a window_size over 1, messages are rendered in a background thread up to 2 windows ahead of sending,
+    and each window is sent as one batch, so rendering overlaps with waiting on the SMTP server.
+    """
+    if window_size <= 1:
+        raw = sends_raw_messages()
+        for subscriber in subscribers:
+            message_instance = None
+            try:
+                message_instance = MessageClass(drip, subscriber, send_context=send_context)
+                sent = send_batch([sendable_message(message_instance, raw)])[0]
             except Exception as e:
-                logger.exception("Cannot reach EMAIL_BACKEND %s. (%r)", settings.EMAIL_BACKEND, e)
-
-            for subscriber_id in subscriber_id_list:
-                try:
-                    sentdrip = SendDrip.objects.get(subscriber_id=subscriber_id, drip_id=drip_id)
-
-                    try:
-                        if sentdrip.sent is False:
-                            subscriber = Subscriber.objects.get(id=subscriber_id)
-
-                            message_instance = MessageClass(drip, subscriber)
-
-                            sent = conn.send_messages([message_instance.message])
-                            if sent is not None:
-                                sentdrip.sent = True
-                                sentdrip.date = timezone.now()
-                                sentdrip.save()
-                                messages_sent += 1
-                                logger.debug("Successfully sent email message to subscriber %i.", subscriber.pk)
-                                # Move subscriber to next step only after their drip has been sent
-                                subscriber.move_to_step(next_step_id)
-                                process_sent.delay(
-                                    user_id=subscriber.id,
-                                    subject=message_instance.subject,
-                                    drip_id=drip_id,
-                                    drip_name=drip.name,
-                                    source='broadcast',
-                                    split='main'
-                                )
-                    except ObjectDoesNotExist as e: #user doesn't exist
-                        logger.warning("Subscriber_id %i does not exist. (%r)", subscriber_id, e)
-                        continue
-                    except Exception as e:
-                        logger.warning("Failed to send email message to %i. (%r)", subscriber_id, e)
-                        #send_drip.retry([[message], combined_kwargs], exc=e, throw=False)
-                        continue
-                except SendDrip.MultipleObjectsReturned:
-                    logger.warning("Multiple SendDrips returned for subscriber_id: %i, drip_id: %i", subscriber_id, drip_id)
-                    continue
-                except SendDrip.DoesNotExist:
-                    # a senddrip doesn't exist, shouldn't happen, but if it does, skip it
-                    logger.warning("Can't find a SendDrip object for subscriber_id: %i, drip_id: %i", subscriber_id, drip_id)
-                    continue
-            conn.close()
-        finally:
-            release_lock()
-            logger.info("Drip_id %i chunk successfully sent: %i", drip_id, messages_sent)
+                logger.warning("Failed to send email message to %i. (%r)", subscriber.id, e)
+                sent = False
+            yield subscriber, message_instance, sent
         return
-    logger.debug('Drip_id %i is already being sent by another worker', drip_id)
-    return
+
+    rendered = queue.Queue(maxsize=window_size * 2)
+    stop = threading.Event()
+    renderer = threading.Thread(target=render_messages, args=(MessageClass, drip, subscribers, rendered, stop, send_context))
+    renderer.daemon = True
+    renderer.start()
+    try:
+        done = False
+        while not done:
+            window = []
+            while len(window) < window_size:
+                item = get_rendered(rendered, renderer)
+                if item is None:
+                    done = True
+                    break
+                if isinstance(item, RenderFailed):
+                    raise item.error
+                window.append(item)
+            if not window:
+                continue
+            results = send_batch([message_instance.message for _, message_instance in window])
+            for (subscriber, message_instance), sent in zip(window, results):
+                yield subscriber, message_instance, sent
+    finally:
+        stop.set()
+        renderer.join()
+
+
+@task(bind=True)
+def send_drip(self, subscriber_id_list, backend_kwargs=None, **kwargs):
+    """
+    Used to send drips to massive lists (100k+). Sending a broadcast uses this.
+    Each subscriber's SendDrip is claimed before anything is sent (see SendDripManager.claim), so the same or
+    overlapping chunks can be queued, retried or split without anyone getting the email twice. If this worker dies,
+    what it didn't send can be claimed again once its lease (SQUEEZE_SEND_LEASE) runs out.
+    """
+    next_step_id = kwargs.get('next_step_id', None)
+    broadcast_run_id = kwargs.get('broadcast_run_id', None)
+    drip_id = kwargs['drip_id']
+
+    from squeezemail.handlers import message_class_for, SendContext
+    try:
+        drip = Drip.objects.get(id=drip_id)
+        MessageClass = message_class_for(drip.message_class)
+    except Drip.DoesNotExist:
+        logger.warning("Drip %i doesn't exist" % drip_id)
+        return
+
+    claim, claimed_ids = SendDrip.objects.claim(drip_id, subscriber_id_list)
+    if not claimed_ids:
+        logger.debug('Drip_id %i chunk is already sent or being sent by another worker', drip_id)
+        return
+    BroadcastRun.increment(broadcast_run_id, claimed=len(claimed_ids))
+
+    messages_sent = 0
+    try:
+        subscribers = Subscriber.objects.select_related('user').in_bulk(claimed_ids)
+        to_send = []
+        for subscriber_id in subscriber_id_list:
+            if subscriber_id not in claimed_ids:
+                # already sent, being sent, or a senddrip doesn't exist (shouldn't happen, but if it does, skip it)
+                continue
+            subscriber = subscribers.get(subscriber_id)
+            if subscriber is None:  # user doesn't exist
+                logger.warning("Subscriber_id %i does not exist.", subscriber_id)
+                continue
+            to_send.append(subscriber)
+
+        # the domain, tracking urls and from address, worked out once for the whole chunk
+        send_context = SendContext()
+        with batch_sender(backend_kwargs) as (send_batch, window_size):
+            # Subscribers whose drip has been sent but not recorded yet, and which body split they got.
+            # Written back every SQUEEZE_SEND_CHECKPOINT_SIZE.
+            sent_splits = {}
+            # Heartbeat: the claim is renewed at every checkpoint, and whenever half the lease has gone by without one.
+            renew_at = time.time() + SQUEEZE_SEND_LEASE / 2.0
+            try:
+                for subscriber, message_instance, sent in send_rendered_messages(send_batch, MessageClass, drip, to_send, window_size, send_context):
+                    if sent:
+                        split = getattr(message_instance, 'split', None) or Drip.MAIN_SPLIT
+                        sent_splits[subscriber.id] = split
+                        messages_sent += 1
+                        logger.debug("Successfully sent email message to subscriber %i.", subscriber.pk)
+                        process_sent.delay(
+                            user_id=subscriber.id,
+                            subject=message_instance.subject,
+                            drip_id=drip_id,
+                            drip_name=drip.name,
+                            source='broadcast',
+                            split=split
+                        )
+                    if len(sent_splits) >= SQUEEZE_SEND_CHECKPOINT_SIZE:
+                        record_sent_drips(claim, sent_splits, next_step_id, broadcast_run_id)
+                        sent_splits = {}
+                        renew_at = time.time() + SQUEEZE_SEND_LEASE / 2.0
+                    elif time.time() >= renew_at:
+                        SendDrip.objects.renew_claim(claim)
+                        renew_at = time.time() + SQUEEZE_SEND_LEASE / 2.0
+            finally:
+                record_sent_drips(claim, sent_splits, next_step_id, broadcast_run_id)
+    finally:
+        # whatever's still claimed wasn't sent
+        failed = SendDrip.objects.release_claim(claim)
+        BroadcastRun.increment(broadcast_run_id, failed=failed)
+        logger.info("Drip_id %i chunk successfully sent: %i", drip_id, messages_sent)
+    return messages_sent
 
 
 @shared_task()
@@ -309,4 +523,9 @@ try:
     from celery.utils.log import get_task_logger
     logger = get_task_logger(__name__)
 except ImportError:
-    logger = send_drip.get_logger()
\ No newline at end of file
+    logger = send_drip.get_logger()
+
+
+@worker_process_shutdown.connect
+def close_pooled_connections(**kwargs):
+    close_connection_pools()
@@ -0,0 +1,67 @@
+import threading
+
+try:
+    import socketserver
+except ImportError:  # Python 2
+    import SocketServer as socketserver
+
+
+class DummySMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Just enough of an SMTP server to test sending. Refuses recipients starting with 'reject'.
+    """
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.server.sessions += 1
+        self.reply('220 localhost ESMTP')
+        recipients = []
+        for line in iter(self.rfile.readline, b''):
+            command = line.decode('ascii').strip()
+            verb = command[:4].upper()
+            self.server.commands.append(verb)
+            if verb == 'EHLO':
+                self.reply('250-localhost')
+                self.reply('250 8BITMIME')
+            elif verb in ('HELO', 'NOOP'):
+                self.reply('250 OK')
+            elif verb in ('MAIL', 'RSET'):
+                recipients = []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                if command.lower().startswith('rcpt to:<reject'):
+                    self.reply('550 No such user')
+                else:
+                    recipients.append(command)
+                    self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = list(iter(self.rfile.readline, b'.\r\n'))
+                self.server.messages.append((recipients, b''.join(data)))
+                recipients = []
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Not implemented')
+
+
+class DummySMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), DummySMTPHandler)
+        self.port = self.server_address[1]
+        self.messages = []
+        self.commands = []
+        self.sessions = 0
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -8,9 +8,9 @@ from django.core import mail
 from django.conf import settings
 from django.utils import timezone
 
-from .models import Drip, SendDrip, QuerySetRule
-from .drips import DripBase, DripMessage
-from .utils import get_user_model, unicode
+from ..models import Drip, SendDrip, QuerySetRule
+from ..drips import DripBase, DripMessage
+from ..utils import get_user_model, unicode
 
 #from credits.models import Profile
 
@@ -0,0 +1,202 @@
+from datetime import timedelta
+from email.header import decode_header, make_header
+
+import html2text
+
+try:
+    from email import message_from_bytes
+except ImportError:  # Python 2
+    from email import message_from_string as message_from_bytes
+
+try:
+    from unittest import mock
+except ImportError:  # Python 2
+    import mock
+
+try:
+    from urllib.parse import quote_plus
+except ImportError:  # Python 2
+    from urllib import quote_plus
+
+from django.core import mail
+from django.core.urlresolvers import reverse
+from django.template import Context
+from django.test import TestCase
+from django.utils import timezone
+
+from ..models import Drip, Subscriber
+from ..utils import unicode
+
+
+class CompiledDripTestCase(TestCase):
+    def test_compiled_once_per_drip_version(self):
+        from ..handlers import CompiledDrip
+        drip = Drip(id=1234, name='Compiled', lastchanged=timezone.now())
+        renders = []
+
+        def render_body():
+            renders.append(1)
+            return 'Hi {{ subscriber }}'
+
+        compiled = CompiledDrip.for_drip(drip, render_body)
+        self.assertIs(CompiledDrip.for_drip(drip, render_body), compiled)
+        self.assertIs(compiled.subject('Hello'), compiled.subject('Hello'))
+        self.assertEqual(len(renders), 1)
+
+        drip.lastchanged += timedelta(seconds=1)
+        self.assertIsNot(CompiledDrip.for_drip(drip, render_body), compiled)
+        self.assertEqual(len(renders), 2)
+
+
+class LinkPlanTestCase(TestCase):
+    def test_links_rewritten_with_subscriber_params(self):
+        from ..handlers import LinkPlan
+        content = '<a href="/page/?a=1">x</a> and <a href="http://other.com/y">y</a>'
+        plan = LinkPlan(content, 'example.com', ['sq_subscriber_id'])
+        self.assertEqual(len(plan.links), 2)
+        for subscriber_id in (1, 2):
+            rendered = plan.render('sq_subscriber_id=%i' % subscriber_id)
+            self.assertEqual(rendered.count('sq_subscriber_id=%i' % subscriber_id), 2)
+            self.assertIn('a=1&sq_target=http%3A%2F%2Fexample.com%2Fpage%2F&', rendered)
+            self.assertIn('sq_target=http%3A%2F%2Fother.com%2Fy&', rendered)
+            self.assertTrue(rendered.endswith('">y</a>'))
+
+    def test_plain_text_is_converted_once_and_personalized(self):
+        from ..handlers import LinkPlan
+        plan = LinkPlan('<p>Hi <a href="http://other.com/y">there</a></p>', 'example.com', ['sq_subscriber_id'])
+        with mock.patch('squeezemail.handlers.html2text.HTML2Text', wraps=html2text.HTML2Text) as converter:
+            first = plan.render_plain('sq_subscriber_id=1')
+            second = plan.render_plain('sq_subscriber_id=2')
+        self.assertEqual(converter.call_count, 1)
+        self.assertIn('[there](', first)
+        self.assertIn('sq_subscriber_id=1)', first)
+        self.assertIn('sq_subscriber_id=2)', second)
+
+
+class PersonalizedDripTestCase(TestCase):
+    body = ('<p>Hi {{ subscriber.email }}, {% if subscriber.is_active %}welcome{% endif %}. '
+            '<a href="http://example.com/offer/?code={{ subscriber.id }}">Offer</a> <a href="/page/">Page</a></p>')
+
+    def test_body_is_planned_and_converted_once_per_drip(self):
+        from ..handlers import DripMessage, SendContext
+        drip = Drip.objects.create(name='Personalized')
+        drip.subjects.create(text='Hi {{ subscriber.email }}')
+        subscribers = [Subscriber.objects.create(email='%i@example.com' % i) for i in range(3)]
+        send_context = SendContext(domain='example.com')
+        with mock.patch('squeezemail.handlers.DripMessage.render_body', return_value={'main': self.body}), \
+                mock.patch('squeezemail.handlers.html2text.HTML2Text', wraps=html2text.HTML2Text) as converter:
+            messages = [DripMessage(drip, subscriber, send_context=send_context) for subscriber in subscribers]
+            rendered = [(message.subscriber, message.body, message.plain) for message in messages]
+        self.assertEqual(converter.call_count, 1)
+        self.assertIs(messages[0].link_plan, messages[-1].link_plan)
+        for subscriber, body, plain in rendered:
+            for text in (body, plain):
+                self.assertIn('Hi %s, welcome.' % subscriber.email, text)
+                self.assertIn('code=%i&' % subscriber.id, text)
+                self.assertNotIn('x9f27b1', text)
+            self.assertIn('sq_target=http%3A%2F%2Fexample.com%2Foffer%2F&', body)
+        # both links in the content point at the click tracker with the subscriber's params
+        for message in messages:
+            content = message.context['content']
+            self.assertEqual(content.count('sq_subscriber_id=%i' % message.subscriber.id), 2)
+            self.assertEqual(content.count(send_context.link_url), 2)
+
+
+    def test_quoted_url_tag_in_href(self):
+        from ..handlers import DripMessage, SendContext
+        drip = Drip.objects.create(name='Url tag')
+        drip.subjects.create(text='Hi')
+        subscriber = Subscriber.objects.create(email='a@example.com')
+        body = '<p><a href="{% url "squeezemail:unsubscribe" %}?a=1">Leave</a></p>'
+        with mock.patch('squeezemail.handlers.DripMessage.render_body', return_value={'main': body}):
+            message = DripMessage(drip, subscriber, send_context=SendContext(domain='example.com'))
+            content, plain = message.context['content'], message.plain
+        target = 'sq_target=%s&' % quote_plus('http://example.com%s' % reverse('squeezemail:unsubscribe'))
+        for text in (content, plain):
+            self.assertIn(target, text)
+            self.assertIn('a=1&', text)
+            self.assertIn('sq_subscriber_id=%i' % subscriber.id, text)
+
+
+class SendContextTestCase(TestCase):
+    def test_urls_and_from_email(self):
+        from ..handlers import SendContext
+        send_context = SendContext(domain='example.com', protocol='https')
+        self.assertEqual(send_context.link_url, 'https://example.com%s' % reverse('squeezemail:link'))
+        drip = Drip(id=1, name='From', from_email='drips@example.com', from_email_name='Drips')
+        self.assertEqual(send_context.from_email(drip), 'Drips <drips@example.com>')
+
+
+class RenderPoolTestCase(TestCase):
+    class Message(object):
+        def __init__(self, drip, subscriber, send_context=None):
+            if subscriber.email.startswith('broken'):
+                raise ValueError(subscriber.email)
+            self.subject = 'Hi %s' % subscriber.email
+            self.message = mail.EmailMessage(self.subject, 'Body', 'drips@example.com', [subscriber.email])
+
+    def test_renders_serialized_messages_in_order(self):
+        from ..rendering import RenderPool, RENDER_BATCH_SIZE
+        drip = Drip(id=1, name='Render')
+        emails = ['%s%i@example.com' % ('broken' if i == 3 else 'ok', i) for i in range(RENDER_BATCH_SIZE * 2 + 1)]
+        subscribers = [Subscriber(id=i, email=email) for i, email in enumerate(emails)]
+        rendered = list(RenderPool(size=2, kind='thread').render(self.Message, drip, None, subscribers))
+        self.assertEqual([r.subscriber.email for r in rendered], [e for e in emails if not e.startswith('broken')])
+        self.assertEqual(rendered[0].message.to, ['ok0@example.com'])
+        raw = rendered[0].message.message().as_bytes(linesep='\r\n')
+        self.assertIn(b'Subject: Hi ok0@example.com\r\n', raw)
+
+
+class MimeSkeletonTestCase(TestCase):
+    def test_assembled_message_parses_back(self):
+        from ..rendering import MimeSkeleton
+        skeleton = MimeSkeleton('Drips <drips@example.com>')
+        html = u'<p>H\xe9llo = <a href="http://example.com/?a=1">there</a></p>\n' * 50
+        raw = skeleton.assemble('bob@example.com', u'Subj\xe9ct', u'H\xe9llo\n', html).message().as_bytes()
+        parsed = message_from_bytes(raw)
+        self.assertEqual(parsed['To'], 'bob@example.com')
+        self.assertEqual(unicode(make_header(decode_header(parsed['Subject']))), u'Subj\xe9ct')
+        plain_part, html_part = parsed.get_payload()
+        self.assertEqual(plain_part.get_payload(decode=True).decode('utf-8'), u'H\xe9llo\r\n')
+        self.assertEqual(html_part.get_content_type(), 'text/html')
+        self.assertEqual(html_part.get_payload(decode=True).decode('utf-8'), html.replace('\n', '\r\n'))
+
+
+class SubjectSplitTestCase(TestCase):
+    def test_allocator_is_deterministic_and_weighted(self):
+        from ..splits import SplitAllocator
+        allocator = SplitAllocator(['a', 'b', 'c'], [3, 1, 0])
+        chosen = [allocator.choose('subject', 1, subscriber_id) for subscriber_id in range(4000)]
+        self.assertEqual(chosen, [allocator.choose('subject', 1, subscriber_id) for subscriber_id in range(4000)])
+        self.assertNotIn('c', chosen)
+        self.assertAlmostEqual(chosen.count('a') / 4000.0, 0.75, delta=0.03)
+
+    def test_subjects_loaded_once_per_drip_version(self):
+        drip = Drip.objects.create(name='Subjects')
+        first = drip.subjects.create(text='First', weight=1)
+        second = drip.subjects.create(text='Second', weight=1)
+        drip.refresh_from_db()
+        chosen = drip.choose_subject(1)
+        with self.assertNumQueries(0):
+            self.assertEqual(set(drip.choose_subject(i) for i in range(100)), set([first, second]))
+            self.assertEqual(drip.choose_subject(1), chosen)
+
+        # a subject change touches the drip, so it's picked up by the next Drip fetched
+        second.weight = 0
+        second.save()
+        drip = Drip.objects.get(id=drip.id)
+        self.assertEqual(set(drip.choose_subject(i) for i in range(100)), set([first]))
+
+
+class BodySplitTestCase(TestCase):
+    def test_each_variant_compiled_and_split_by_subscriber(self):
+        from ..handlers import CompiledDrip
+        drip = Drip(id=4321, name='Body split', lastchanged=timezone.now())
+        compiled = CompiledDrip.for_drip(drip, lambda: {'main': 'A {{ name }}', 'split_test': 'B {{ name }}'})
+        splits = [compiled.choose_split(drip.id, subscriber_id) for subscriber_id in range(200)]
+        self.assertEqual(splits, [compiled.choose_split(drip.id, subscriber_id) for subscriber_id in range(200)])
+        self.assertEqual(set(splits), set(['main', 'split_test']))
+        self.assertEqual(compiled.contents['split_test'].render(Context({'name': 'Bob'})), 'B Bob')
+
+        main_only = CompiledDrip(drip, 'A {{ name }}')
+        self.assertEqual(main_only.choose_split(drip.id, 1), 'main')
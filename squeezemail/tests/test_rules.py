@@ -0,0 +1,69 @@
+from datetime import timedelta
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils import timezone
+
+from ..models import Decision, QuerySetRule, Subscriber
+from ..rules import get_rule_plan, rule_plan_cache_key, _local_plans
+
+
+class CompiledRuleTestCase(TestCase):
+    def test_relative_value_binds_to_now(self):
+        now = timezone.now()
+        rule = QuerySetRule(field_name='created', lookup_type='lte', field_value='now-7 days')
+        kwargs = rule.compile().filter_kwargs(now)
+        self.assertEqual(kwargs, {'created__lte': now - timedelta(days=7)})
+
+    def test_today_value_is_a_date(self):
+        now = timezone.now()
+        rule = QuerySetRule(field_name='created', lookup_type='gte', field_value='today+3 days')
+        kwargs = rule.compile().filter_kwargs(now)
+        self.assertEqual(kwargs, {'created__gte': now.date() + timedelta(days=3)})
+
+    def test_count_rule_filters_on_its_annotation(self):
+        rule = QuerySetRule(field_name='send_drips__count', lookup_type='gt', field_value='2')
+        compiled = rule.compile()
+        self.assertEqual(compiled.filter_kwargs(timezone.now()), {'num_send_drips__gt': '2'})
+        self.assertEqual(compiled.aggregate, 'send_drips')
+        self.assertEqual(compiled.annotated_field_name, 'num_send_drips')
+
+    def test_boolean_value(self):
+        rule = QuerySetRule(field_name='is_active', lookup_type='exact', field_value='False')
+        self.assertEqual(rule.compile().filter_kwargs(timezone.now()), {'is_active__exact': False})
+
+
+class RulePlanTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.decision = Decision.objects.create()
+        self.rule = QuerySetRule.objects.create(content_object=self.decision, field_name='email', lookup_type='endswith',
+                                                field_value='@a.com')
+        Subscriber.objects.create(email='x@a.com')
+        Subscriber.objects.create(email='y@b.com')
+
+    def emails(self):
+        return list(get_rule_plan(self.decision).apply(Subscriber.objects.all()).values_list('email', flat=True))
+
+    def test_plan_is_reused_until_its_rules_change(self):
+        plan = get_rule_plan(self.decision)
+        with self.assertNumQueries(1):
+            self.assertIs(get_rule_plan(self.decision), plan)
+
+        # .update() doesn't send post_save, the new lastchanged is enough
+        QuerySetRule.objects.filter(id=self.rule.id).update(field_value='@b.com', lastchanged=timezone.now())
+        self.assertEqual(self.emails(), ['y@b.com'])
+
+        self.rule.delete()
+        self.assertEqual(sorted(self.emails()), ['x@a.com', 'y@b.com'])
+
+    def test_stale_plan_cached_after_a_change_is_not_used(self):
+        stale = get_rule_plan(self.decision)
+        self.rule.field_value = '@b.com'
+        self.rule.save()
+        # a slower worker caches the plan it built before the change
+        plan_key = rule_plan_cache_key(ContentType.objects.get_for_model(self.decision).id, self.decision.pk)
+        cache.set(plan_key, stale)
+        _local_plans[plan_key] = stale
+        self.assertEqual(self.emails(), ['y@b.com'])
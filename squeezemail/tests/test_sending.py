@@ -0,0 +1,447 @@
+import unittest
+from io import StringIO
+from datetime import timedelta
+
+try:
+    from unittest import mock
+except ImportError:  # Python 2
+    import mock
+
+try:
+    import aiosmtplib
+except ImportError:
+    aiosmtplib = None
+
+from django.core import mail
+from django.core.cache import cache
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from ..models import Drip, SendDrip, Subscriber, BroadcastRun, Delay, Step
+from ..tasks import record_sent_drips
+from ..throttle import SendThrottle
+from .smtp import DummySMTPServer
+
+
+@unittest.skipUnless(aiosmtplib, 'aiosmtplib is not installed')
+class AsyncSMTPSenderTestCase(TestCase):
+    def setUp(self):
+        self.server = DummySMTPServer()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_sends_concurrently_and_reports_each_message(self):
+        from ..async_smtp import AsyncSMTPSender
+        messages = [mail.EmailMessage('Hi', 'Body', 'from@example.com', [to]) for to in
+                    ['a@example.com', 'reject@example.com', 'b@example.com', 'c@example.com']]
+        with AsyncSMTPSender(host='127.0.0.1', port=self.server.port, username='', password='',
+                             use_tls=False, use_ssl=False, timeout=5, concurrency=2) as sender:
+            results = sender.send_messages_with_results(messages)
+            # sessions are reused for the next batch
+            results += sender.send_messages_with_results(messages[:1])
+        self.assertEqual(results, [True, False, True, True, True])
+        self.assertEqual(len(self.server.messages), 4)
+
+    def test_one_sender_per_process(self):
+        from ..connections import batch_sender, close_connection_pools
+        backend_kwargs = {'host': '127.0.0.1', 'port': self.server.port, 'username': '', 'password': '',
+                          'use_tls': False, 'use_ssl': False, 'timeout': 5}
+        message = mail.EmailMessage('Hi', 'Body', 'from@example.com', ['a@example.com'])
+        with mock.patch('squeezemail.connections.SQUEEZE_SEND_ENGINE', 'async'):
+            with batch_sender(backend_kwargs) as (send_batch, window_size):
+                self.assertEqual(send_batch([message]), [True])
+                sender = send_batch.__self__
+            with batch_sender(backend_kwargs) as (send_batch, window_size):
+                self.assertIs(send_batch.__self__, sender)
+                # the session opened for the last chunk is still open
+                self.assertEqual(len(sender._idle), 1)
+            with mock.patch('squeezemail.connections.os.getpid', return_value=-1):
+                with batch_sender(backend_kwargs) as (send_batch, window_size):
+                    self.assertIsNot(send_batch.__self__, sender)
+                    self.assertEqual(send_batch([message]), [True])
+                    forked_sender = send_batch.__self__
+            self.assertIsNotNone(forked_sender._loop)
+            # shutting the worker process down closes the senders
+            close_connection_pools()
+        self.assertIsNone(forked_sender._loop)
+        sender.close()
+
+
+class RateLimiterTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_tokens_are_spread_across_the_second(self):
+        from ..throttle import RateLimiter
+        clock = [1000.0]
+
+        def sleep(seconds):
+            clock[0] += seconds
+
+        with mock.patch('squeezemail.throttle.time') as fake_time:
+            fake_time.time.side_effect = lambda: clock[0]
+            fake_time.sleep.side_effect = sleep
+            limiter = RateLimiter('test', 4)
+            waits = [limiter.acquire() for _ in range(6)]
+        # 4 a second, a quarter second apart. The 5th waits for the next second.
+        self.assertEqual(waits, [0, 0.25, 0.25, 0.25, 0.25, 0.25])
+
+
+class SendThrottleTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def message(self, to):
+        return mail.EmailMessage('Hi', 'Body', 'from@example.com', [to])
+
+    @mock.patch('squeezemail.throttle.SQUEEZE_SEND_RATE_LIMIT', None)
+    @mock.patch('squeezemail.throttle.SQUEEZE_DOMAIN_RATE_LIMITS', {'Example.com': 2})
+    def test_domain_limits(self):
+        throttle = SendThrottle('relay:25')
+        self.assertEqual([limiter.name for limiter in throttle.limiters_for(self.message('A <a@EXAMPLE.com>'))],
+                         ['domain-example.com'])
+        self.assertEqual(throttle.limiters_for(self.message('b@other.com')), [])
+
+        clock = [1000.0]
+
+        def sleep(seconds):
+            clock[0] += seconds
+
+        with mock.patch('squeezemail.throttle.time') as fake_time:
+            fake_time.time.side_effect = lambda: clock[0]
+            fake_time.sleep.side_effect = sleep
+            waits = [throttle.wait(self.message(to)) for to in
+                     ['a@example.com', 'b@other.com', 'c@example.com', 'd@other.com', 'e@example.com']]
+        # only example.com is limited, to 2 a second
+        self.assertEqual(waits, [0, 0, 0.5, 0, 0.5])
+
+    def test_is_temporary_failure(self):
+        import smtplib
+
+        class SMTPServerDisconnected(Exception):
+            # aiosmtplib's, which isn't a subclass of smtplib's
+            pass
+
+        is_temporary_failure = SendThrottle.is_temporary_failure
+        self.assertTrue(is_temporary_failure(smtplib.SMTPServerDisconnected()))
+        self.assertTrue(is_temporary_failure(SMTPServerDisconnected()))
+        self.assertTrue(is_temporary_failure(smtplib.SMTPResponseException(421, 'Too many connections')))
+        self.assertTrue(is_temporary_failure(mock.Mock(spec=['code'], code=451)))
+        self.assertFalse(is_temporary_failure(smtplib.SMTPResponseException(550, 'No such user')))
+        self.assertFalse(is_temporary_failure(
+            smtplib.SMTPRecipientsRefused({'a@example.com': (450, 'Mailbox busy')})))
+        self.assertFalse(is_temporary_failure(ValueError()))
+
+    def send_message(self, *send_results):
+        import smtplib
+        from ..connections import send_message
+        send = mock.Mock(side_effect=[smtplib.SMTPResponseException(code, 'error') if code else 1
+                                      for code in send_results])
+        reconnect = mock.Mock()
+        throttle = SendThrottle('relay:25')
+        with mock.patch.object(throttle, 'back_off') as back_off:
+            sent = send_message(send, self.message('a@example.com'), throttle, reconnect=reconnect)
+        return sent, send.call_count, back_off.call_count, reconnect.call_count
+
+    def test_send_message_retries_once_after_a_temporary_failure(self):
+        # sent, send attempts, back offs, reconnects
+        self.assertEqual(self.send_message(421, None), (True, 2, 1, 1))
+        self.assertEqual(self.send_message(421, 421), (False, 2, 1, 1))
+
+    def test_send_message_does_not_retry_a_permanent_failure(self):
+        self.assertEqual(self.send_message(550), (False, 1, 0, 0))
+
+
+class SendDripClaimTestCase(TestCase):
+    def setUp(self):
+        self.drip = Drip.objects.create(name='A Drip to claim')
+        self.subscriber_ids = [Subscriber.objects.create(email='%i@example.com' % i).id for i in range(4)]
+        SendDrip.objects.bulk_create_unsent(self.drip.id, self.subscriber_ids)
+
+    def test_overlapping_claims_do_not_share_subscribers(self):
+        first_claim, first_ids = SendDrip.objects.claim(self.drip.id, self.subscriber_ids[:3])
+        second_claim, second_ids = SendDrip.objects.claim(self.drip.id, self.subscriber_ids[1:])
+        self.assertEqual(first_ids, set(self.subscriber_ids[:3]))
+        self.assertEqual(second_ids, set(self.subscriber_ids[3:]))
+
+    def test_expired_and_released_claims_can_be_claimed_again(self):
+        claim, claimed_ids = SendDrip.objects.claim(self.drip.id, self.subscriber_ids, lease=-1)
+        SendDrip.objects.mark_sent(claim, self.subscriber_ids[:1])
+        reclaim, reclaimed_ids = SendDrip.objects.claim(self.drip.id, self.subscriber_ids)
+        self.assertEqual(reclaimed_ids, set(self.subscriber_ids[1:]))
+
+        SendDrip.objects.release_claim(reclaim)
+        self.assertEqual(SendDrip.objects.filter(state=SendDrip.FAILED).count(), 3)
+        _, retried_ids = SendDrip.objects.claim(self.drip.id, self.subscriber_ids)
+        self.assertEqual(retried_ids, set(self.subscriber_ids[1:]))
+
+    def test_sent_splits_are_recorded_and_counted(self):
+        from ..tasks import record_sent_drips
+        claim, claimed_ids = SendDrip.objects.claim(self.drip.id, self.subscriber_ids)
+        first, second, third = self.subscriber_ids[:3]
+        record_sent_drips(claim, {first: 'main', second: 'split_test', third: 'split_test'})
+        self.assertEqual(SendDrip.objects.get(drip=self.drip, subscriber_id=second).split, 'split_test')
+        stats = self.drip.split_test_stats()
+        self.assertEqual(stats['main']['sent'], 1)
+        self.assertEqual(stats['split_test'], {'sent': 2, 'opened': 0, 'clicked': 0})
+
+
+class SendDripQueriesTestCase(TestCase):
+    def setUp(self):
+        self.drip = Drip.objects.create(name='A Broadcast', from_email='drips@example.com')
+        self.subscriber_ids = [Subscriber.objects.create(email='%i@example.com' % i).id for i in range(6)]
+        SendDrip.objects.bulk_create_unsent(self.drip.id, self.subscriber_ids)
+
+    def send(self, subscriber_ids, checkpoint_size=100):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from ..tasks import send_drip
+
+        def send_rendered_messages(send_batch, MessageClass, drip, subscribers, window_size, send_context):
+            for subscriber in subscribers:
+                yield subscriber, mock.Mock(subject='Hi', split=None), True
+
+        with mock.patch('squeezemail.tasks.send_rendered_messages', send_rendered_messages), \
+                mock.patch('squeezemail.tasks.process_sent'), \
+                mock.patch('squeezemail.tasks.SQUEEZE_SEND_CHECKPOINT_SIZE', checkpoint_size), \
+                mock.patch('squeezemail.tasks.record_sent_drips', wraps=record_sent_drips) as record, \
+                CaptureQueriesContext(connection) as queries:
+            self.assertEqual(send_drip(subscriber_ids, drip_id=self.drip.id), len(subscriber_ids))
+        return queries, [call[0][1] for call in record.call_args_list]
+
+    def test_chunk_loads_in_a_constant_number_of_queries(self):
+        # the first send fills per process caches (e.g. the current Site)
+        self.send(self.subscriber_ids[:1])
+        few, _ = self.send(self.subscriber_ids[1:2])
+        many, _ = self.send(self.subscriber_ids[2:])
+        self.assertEqual(len(few), len(many))
+        subscriber_selects = [query for query in many.captured_queries
+                              if query['sql'].startswith('SELECT') and 'FROM "squeezemail_subscriber"' in query['sql']]
+        self.assertEqual(len(subscriber_selects), 1)
+
+    def test_sent_flags_are_written_at_checkpoints(self):
+        queries, checkpoints = self.send(self.subscriber_ids[:5], checkpoint_size=2)
+        self.assertEqual([sorted(sent_splits) for sent_splits in checkpoints],
+                         [self.subscriber_ids[:2], self.subscriber_ids[2:4], self.subscriber_ids[4:5]])
+        self.assertEqual(len([query for query in queries.captured_queries
+                              if query['sql'].startswith('UPDATE "squeezemail_senddrip" SET "sent" = true')]), 3)
+        self.assertEqual(SendDrip.objects.filter(drip=self.drip, sent=True, state=SendDrip.SENT).count(), 5)
+
+
+class HandleDripSendTestCase(TestCase):
+    def test_sent_subscribers_move_to_next_step_together(self):
+        from ..handlers import HandleDrip
+        drip = Drip.objects.create(name='A Step Drip', from_email='drips@example.com')
+        drip.subjects.create(text='Hi')
+        step = Step.objects.create(content_object=drip)
+        next_step = Step.objects.create(parent=step, content_object=Delay.objects.create(duration=timedelta(days=2)))
+        for i in range(3):
+            Subscriber.objects.create(email='%i@example.com' % i, step=step)
+
+        with mock.patch('squeezemail.handlers.process_sent'), \
+                mock.patch.object(Delay, 'get_due_at', wraps=Delay.get_due_at) as get_due_at:
+            count = HandleDrip(drip_model=drip, queryset=step.subscribers.all(), step=step).send(next_step=next_step)
+        self.assertEqual(count, 3)
+        self.assertEqual(len(mail.outbox), 3)
+        # the next step's delay is looked up once for the whole send
+        self.assertEqual(get_due_at.call_count, 1)
+        moved = Subscriber.objects.filter(step=next_step)
+        self.assertEqual(moved.count(), 3)
+        self.assertEqual(moved.values('step_timestamp', 'due_at').distinct().count(), 1)
+        subscriber = moved[0]
+        self.assertEqual(subscriber.due_at, subscriber.step_timestamp + timedelta(days=2))
+
+    def test_only_subscribers_that_got_the_drip_move_on(self):
+        from ..handlers import HandleDrip
+        drip = Drip.objects.create(name='A Step Drip', from_email='drips@example.com')
+        drip.subjects.create(text='Hi')
+        step = Step.objects.create(content_object=drip)
+        next_step = Step.objects.create(parent=step, description='next')
+        for i in range(3):
+            Subscriber.objects.create(email='%i@example.com' % i, step=step)
+
+        def send_messages_with_results(conn, messages, throttle):
+            return [message.to != ['1@example.com'] for message in messages]
+
+        with mock.patch('squeezemail.handlers.process_sent'), \
+                mock.patch('squeezemail.handlers.send_messages_with_results', send_messages_with_results):
+            count = HandleDrip(drip_model=drip, queryset=step.subscribers.all(), step=step).send(next_step=next_step)
+        self.assertEqual(count, 2)
+        self.assertEqual(dict(Subscriber.objects.values_list('email', 'step_id')), {
+            '0@example.com': next_step.id,
+            '1@example.com': step.id,
+            '2@example.com': next_step.id,
+        })
+        self.assertEqual(SendDrip.objects.filter(drip=drip, sent=True).count(), 2)
+
+
+class ConnectionPoolTestCase(TestCase):
+    def setUp(self):
+        self.server = DummySMTPServer()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def get_pool(self, **kwargs):
+        from ..connections import ConnectionPool
+        return ConnectionPool('django.core.mail.backends.smtp.EmailBackend', host='127.0.0.1', port=self.server.port,
+                              username='', password='', use_tls=False, use_ssl=False, timeout=5, **kwargs)
+
+    def test_idle_connections_are_reused_and_checked(self):
+        pool = self.get_pool(check_interval=60)
+        with pool.connection() as first:
+            pass
+        with pool.connection() as conn:
+            self.assertIs(conn, first)
+        # used too recently to need a NOOP
+        self.assertNotIn('NOOP', self.server.commands)
+
+        pool.check_interval = 0
+        with pool.connection() as conn:
+            self.assertIs(conn, first)
+        self.assertEqual(self.server.commands.count('NOOP'), 1)
+        self.assertEqual(self.server.sessions, 1)
+        pool.close()
+
+    def test_old_connections_are_recycled(self):
+        pool = self.get_pool(max_age=60)
+        with mock.patch('squeezemail.connections.time.time', return_value=1000):
+            with pool.connection() as first:
+                smtp = first.connection
+        with mock.patch('squeezemail.connections.time.time', return_value=1061):
+            with pool.connection() as conn:
+                self.assertIsNot(conn, first)
+                self.assertIsNotNone(conn.connection)
+        # the old one was closed (QUIT)
+        self.assertIsNone(first.connection)
+        self.assertIsNot(conn.connection, smtp)
+        pool.close()
+
+    def test_dropped_connections_are_reopened(self):
+        from ..connections import send_messages_with_results
+        pool = self.get_pool(check_interval=0)
+        with pool.connection() as first:
+            first.connection.close()
+        with pool.connection() as conn:
+            # the dead idle connection failed its NOOP and was thrown away
+            self.assertIsNot(conn, first)
+            conn.connection.close()
+            messages = [mail.EmailMessage('Hi', 'Body', 'from@example.com', [to])
+                        for to in ['a@example.com', 'reject@example.com', 'b@example.com']]
+            with mock.patch('squeezemail.throttle.time.sleep'):
+                # the first send finds the connection gone, reconnects and tries again
+                self.assertEqual(send_messages_with_results(conn, messages, SendThrottle()), [True, False, True])
+        self.assertEqual(len(self.server.messages), 2)
+        pool.close()
+
+    def test_connections_are_limited_to_max_size(self):
+        import threading
+        pool = self.get_pool(max_size=1)
+        got_connection = threading.Event()
+
+        def use_pool():
+            with pool.connection():
+                got_connection.set()
+
+        with pool.connection():
+            thread = threading.Thread(target=use_pool)
+            thread.start()
+            self.assertFalse(got_connection.wait(0.2))
+        self.assertTrue(got_connection.wait(5))
+        thread.join()
+        # the second user got the same connection back
+        self.assertEqual(len(pool._idle), 1)
+        self.assertEqual(self.server.sessions, 1)
+        pool.close()
+
+
+class SendRenderedMessagesTestCase(TestCase):
+    def send(self, render):
+        from ..tasks import send_rendered_messages
+        subscribers = [Subscriber(id=i, email='%i@example.com' % i) for i in range(5)]
+        with mock.patch('squeezemail.tasks.RenderPool') as pool:
+            pool.return_value.render.side_effect = render
+            return list(send_rendered_messages(lambda messages: [True] * len(messages), None, None, subscribers,
+                                               window_size=2))
+
+    def test_render_error_is_raised_by_the_sender(self):
+        def render(MessageClass, drip, send_context, subscribers):
+            yield mock.Mock(subscriber=subscribers[0])
+            raise ValueError('template is broken')
+
+        with self.assertRaisesRegexp(ValueError, 'template is broken'):
+            self.send(render)
+
+    def test_dead_render_thread_is_noticed(self):
+        with mock.patch('squeezemail.tasks.render_messages'):
+            with self.assertRaises(RuntimeError):
+                self.send(None)
+
+
+class ConsoleBackendTestCase(TransactionTestCase):
+    # committed, so the render thread's own database connection can see the drip
+    @override_settings(EMAIL_BACKEND='django.core.mail.backends.console.EmailBackend')
+    def test_window_mode_sends_through_the_console_backend(self):
+        from ..tasks import send_drip
+        drip = Drip.objects.create(name='A Console Drip', from_email='drips@example.com')
+        drip.subjects.create(text='Hi')
+        subscriber_ids = [Subscriber.objects.create(email='%i@example.com' % i).id for i in range(3)]
+        SendDrip.objects.bulk_create_unsent(drip.id, subscriber_ids)
+        stream = StringIO()
+        with mock.patch('squeezemail.connections.SQUEEZE_SEND_WINDOW_SIZE', 2), \
+                mock.patch('squeezemail.tasks.process_sent'):
+            sent = send_drip(subscriber_ids, backend_kwargs={'stream': stream}, drip_id=drip.id)
+        self.assertEqual(sent, 3)
+        self.assertEqual(stream.getvalue().count('Subject: Hi'), 3)
+        self.assertEqual(SendDrip.objects.filter(drip=drip, sent=True).count(), 3)
+
+
+class UnsentDripChunksTestCase(TestCase):
+    def setUp(self):
+        from ..handlers import HandleDrip
+        self.drip = Drip.objects.create(name='A Broadcast', from_email='drips@example.com')
+        self.subscriber_ids = [Subscriber.objects.create(email='%i@example.com' % i).id for i in range(7)]
+        SendDrip.objects.bulk_create_unsent(self.drip.id, self.subscriber_ids)
+        self.handler = HandleDrip(drip_model=self.drip, queryset=Subscriber.objects.all())
+
+    def mark_sent(self, subscriber_ids):
+        SendDrip.objects.filter(drip=self.drip, subscriber_id__in=subscriber_ids).update(sent=True)
+
+    def test_chunks_visit_every_unsent_id_once(self):
+        ids = self.subscriber_ids
+        seen = []
+        for chunk in self.handler.unsent_subscriber_id_chunks(chunk_size=3):
+            seen.extend(chunk)
+            # the chunk is sent while the next one is read, and a later subscriber is sent by someone else
+            self.mark_sent(chunk + [ids[4]])
+        self.assertEqual(seen, ids[:4] + ids[5:])
+
+    def test_queued_subscribers_are_counted_on_the_broadcast_run(self):
+        broadcast_run = BroadcastRun.objects.create(drip=self.drip)
+        self.mark_sent(self.subscriber_ids[:1])
+        with mock.patch('squeezemail.handlers.SQUEEZE_CELERY_EMAIL_CHUNK_SIZE', 2), \
+                mock.patch('squeezemail.handlers.SQUEEZE_CELERY_PUBLISH_BATCH_SIZE', 2), \
+                mock.patch('squeezemail.handlers.send_drip') as send_drip:
+            queued = self.handler.create_tasks_for_unsent_drips(broadcast_run_id=broadcast_run.id)
+        self.assertEqual(queued, 3)
+        chunks = [call[1]['args'][0] for call in send_drip.apply_async.call_args_list]
+        self.assertEqual(chunks, [self.subscriber_ids[1:3], self.subscriber_ids[3:5], self.subscriber_ids[5:]])
+        self.assertEqual(send_drip.apply_async.call_args[1]['kwargs'],
+                         {'drip_id': self.drip.id, 'broadcast_run_id': broadcast_run.id})
+        # two batches of tasks sharing a producer each, then one that finds nothing left
+        self.assertEqual(send_drip.app.producer_or_acquire.call_count, 3)
+        self.assertEqual(BroadcastRun.objects.get(id=broadcast_run.id).queued, 6)
+
+
+class BroadcastRunTestCase(TestCase):
+    def test_increment_and_progress(self):
+        drip = Drip.objects.create(name='A Broadcast')
+        broadcast_run = BroadcastRun.objects.create(drip=drip)
+        BroadcastRun.increment(broadcast_run.id, queued=10, claimed=10)
+        BroadcastRun.increment(broadcast_run.id, sent=8, failed=2)
+        BroadcastRun.increment(None, sent=100)  # not part of a run
+        progress = BroadcastRun.objects.get(id=broadcast_run.id).progress()
+        self.assertEqual(
+            [progress['queued'], progress['claimed'], progress['sent'], progress['failed']],
+            [10, 10, 8, 2]
+        )
@@ -0,0 +1,379 @@
+from datetime import timedelta
+
+try:
+    from unittest import mock
+except ImportError:  # Python 2
+    import mock
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils import timezone
+
+from ..models import Decision, Delay, EmailActivity, Modify, QuerySetRule, Step, Subscriber
+from ..signals import subscribers_moved
+
+
+class DelayStepRunTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.delay = Delay.objects.create(duration=timedelta(days=1))
+        self.step = Step.objects.create(content_object=self.delay)
+        self.next_step = Step.objects.create(parent=self.step, description='next')
+        now = timezone.now()
+        self.due = self.add_subscriber('due@example.com', step_timestamp=now - timedelta(days=2))
+        self.due_at_passed = self.add_subscriber('due_at@example.com', step_timestamp=now - timedelta(hours=1),
+                                                 due_at=now - timedelta(minutes=1))
+        self.not_due = self.add_subscriber('not_due@example.com', step_timestamp=now - timedelta(hours=1))
+        self.no_timestamp = self.add_subscriber('no_timestamp@example.com', step_timestamp=None)
+
+    def add_subscriber(self, email, **fields):
+        subscriber = Subscriber.objects.create(email=email)
+        # straight to the database, so due_at isn't worked out by move_to_step
+        Subscriber.objects.filter(id=subscriber.id).update(step=self.step, **fields)
+        return subscriber
+
+    def step_ids(self):
+        return dict(Subscriber.objects.values_list('email', 'step_id'))
+
+    def test_moves_only_due_subscribers(self):
+        moved = self.delay.step_run(self.step, self.step.subscribers.filter(is_active=True))
+        self.assertEqual(moved, 2)
+        self.assertEqual(self.step_ids(), {
+            'due@example.com': self.next_step.id,
+            'due_at@example.com': self.next_step.id,
+            'not_due@example.com': self.step.id,
+            'no_timestamp@example.com': self.step.id,
+        })
+        moved_on = Subscriber.objects.get(id=self.due.id)
+        self.assertIsNotNone(moved_on.step_timestamp)
+        # the next step isn't a delay
+        self.assertIsNone(moved_on.due_at)
+
+    def test_get_due_at(self):
+        now = timezone.now()
+        self.assertEqual(Delay.get_due_at(self.step.id, now), now + timedelta(days=1))
+        self.assertIsNone(Delay.get_due_at(self.next_step.id, now))
+        self.assertIsNone(Delay.get_due_at(None, now))
+
+    def test_saving_the_delay_updates_due_at(self):
+        elsewhere = Subscriber.objects.create(email='elsewhere@example.com', step=self.next_step)
+        self.delay.duration = timedelta(hours=2)
+        self.delay.save()
+        for subscriber in Subscriber.objects.filter(step=self.step).exclude(step_timestamp=None):
+            self.assertEqual(subscriber.due_at, subscriber.step_timestamp + timedelta(hours=2))
+        self.assertIsNone(Subscriber.objects.get(id=self.no_timestamp.id).due_at)
+        self.assertIsNone(Subscriber.objects.get(id=elsewhere.id).due_at)
+        # and the delay runs again with its new duration
+        self.assertTrue(Step._base_manager.get(id=self.step.id).is_dirty)
+
+    def test_last_step_moves_nobody(self):
+        self.next_step.delete()
+        moved = self.delay.step_run(self.step, self.step.subscribers.filter(is_active=True))
+        self.assertEqual(moved, 0)
+        self.assertEqual(set(self.step_ids().values()), {self.step.id})
+
+
+class DecisionStepRunTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.on_true = Step.objects.create(description='true')
+        self.on_false = Step.objects.create(description='false')
+        self.decision = Decision.objects.create(on_true=self.on_true, on_false=self.on_false)
+        QuerySetRule.objects.create(content_object=self.decision, field_name='email', lookup_type='endswith',
+                                    field_value='@match.com')
+        self.step = Step.objects.create(content_object=self.decision)
+        for email in ['a@match.com', 'b@match.com', 'c@other.com']:
+            Subscriber.objects.create(email=email, step=self.step)
+
+    def step_run(self):
+        # the decision is loaded again, as Step.run would, so on_true_id/on_false_id are what's saved
+        decision = Decision.objects.get(id=self.decision.id)
+        return decision.step_run(self.step, self.step.subscribers.filter(is_active=True))
+
+    def step_ids(self):
+        return dict(Subscriber.objects.values_list('email', 'step_id'))
+
+    def test_moves_each_branch(self):
+        self.assertEqual(self.step_run(), {'true': 2, 'false': 1})
+        self.assertEqual(self.step_ids(), {
+            'a@match.com': self.on_true.id,
+            'b@match.com': self.on_true.id,
+            'c@other.com': self.on_false.id,
+        })
+
+    def test_without_on_true(self):
+        Decision.objects.filter(id=self.decision.id).update(on_true=None)
+        self.assertEqual(self.step_run(), {'true': 0, 'false': 1})
+        self.assertEqual(self.step_ids(), {
+            'a@match.com': self.step.id,
+            'b@match.com': self.step.id,
+            'c@other.com': self.on_false.id,
+        })
+
+    def test_without_on_false(self):
+        Decision.objects.filter(id=self.decision.id).update(on_false=None)
+        self.assertEqual(self.step_run(), {'true': 2, 'false': 0})
+        self.assertEqual(self.step_ids(), {
+            'a@match.com': self.on_true.id,
+            'b@match.com': self.on_true.id,
+            'c@other.com': self.step.id,
+        })
+
+
+class ShardedStepTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.delay = Delay.objects.create(duration=timedelta(days=1))
+        self.step = Step.objects.create(content_object=self.delay)
+        self.next_step = Step.objects.create(parent=self.step, description='next')
+        for i in range(5):
+            subscriber = Subscriber.objects.create(email='%i@example.com' % i)
+            Subscriber.objects.filter(id=subscriber.id).update(step=self.step,
+                                                                step_timestamp=timezone.now() - timedelta(days=2))
+
+    def test_shard_workers_are_capped(self):
+        from concurrent.futures import ThreadPoolExecutor
+        with mock.patch('squeezemail.models.SQUEEZE_STEP_SHARD_WORKERS', 2), \
+                mock.patch('squeezemail.models.ThreadPoolExecutor', wraps=ThreadPoolExecutor) as executor, \
+                mock.patch.object(Step, 'run_shard'):
+            results, failed = self.step.run_sharded(shard_size=1)
+        self.assertEqual(len(results), 5)
+        executor.assert_called_once_with(max_workers=2)
+
+    def on_step(self):
+        return Subscriber.objects.filter(step=self.step).count()
+
+    def test_step_does_not_run_while_its_shards_are(self):
+        self.assertTrue(self.step.acquire_shards_lock(2))
+        self.assertIsNone(self.step.run())
+        self.assertEqual(self.on_step(), 5)
+        self.step.release_shard()
+        self.step.release_shard()
+        self.assertEqual(self.step.run(), 5)
+        self.assertEqual(self.on_step(), 0)
+
+    def test_shard_size_can_be_passed_to_run_step(self):
+        from ..tasks import get_step_tasks, run_step
+        with mock.patch('squeezemail.tasks.group'):
+            self.assertEqual(run_step(self.step.id, shard_size=2), {'step_id': self.step.id, 'shards': 3})
+        self.step.release_shard()
+        self.step.release_shard()
+        self.step.release_shard()
+        step_tasks = get_step_tasks(run_all=True, shard_size=2)
+        self.assertEqual(set(signature.kwargs['shard_size'] for signature in step_tasks.tasks), set([2]))
+
+    def test_lost_shard_holds_the_step_only_until_the_timeout(self):
+        self.assertTrue(self.step.acquire_shards_lock(2))
+        self.assertFalse(self.step.acquire_shards_lock(2))
+        self.step.release_shard()
+        # the other shard never finishes, and SQUEEZE_STEP_SHARD_TIMEOUT passes without a shard touching the lock
+        self.assertTrue(self.step.shards_running())
+        cache.delete(self.step.shards_heartbeat_id)
+        self.assertFalse(self.step.shards_running())
+        self.assertEqual(self.step.run(), 5)
+        # and it can be sharded again
+        self.assertTrue(self.step.acquire_shards_lock(3))
+        self.assertEqual(cache.get(self.step.shards_lock_id), 3)
+
+    def test_shard_timeout(self):
+        with mock.patch('squeezemail.models.cache') as step_cache, \
+                mock.patch('squeezemail.models.SQUEEZE_STEP_SHARD_TIMEOUT', 600):
+            step_cache.get_many.return_value = {}
+            self.step.acquire_shards_lock(2)
+        step_cache.set.assert_any_call(self.step.shards_heartbeat_id, 'true', 600)
+
+    def test_shards_are_not_queued_while_the_step_runs(self):
+        from ..tasks import run_step, run_step_shard
+        with mock.patch('squeezemail.tasks.SQUEEZE_STEP_SHARD_SIZE', 2), \
+                mock.patch('squeezemail.models.SQUEEZE_STEP_SHARD_SIZE', 2), \
+                mock.patch('squeezemail.tasks.group') as group:
+            self.assertTrue(self.step.acquire_lock())
+            self.assertIsNone(run_step(self.step.id))
+            self.assertFalse(group.called)
+            self.assertFalse(self.step.shards_running())
+
+            self.step.release_lock()
+            self.assertEqual(run_step(self.step.id), {'step_id': self.step.id, 'shards': 3})
+            shards = [signature.args for signature in group.call_args[0][0]]
+        self.assertEqual(len(shards), 3)
+        # the whole step waits for its shards
+        self.assertTrue(self.step.shards_running())
+        self.assertIsNone(self.step.run())
+        self.assertEqual(self.on_step(), 5)
+
+        for args in shards:
+            run_step_shard(*args)
+        self.assertFalse(self.step.shards_running())
+        self.assertEqual(self.on_step(), 0)
+
+
+class SubscriberSaveTestCase(TestCase):
+    def setUp(self):
+        self.first = Step.objects.create(description='first')
+        self.second = Step.objects.create(description='second')
+        self.mark_all_clean()
+
+    def mark_all_clean(self):
+        Step._base_manager.update(is_dirty=False)
+
+    def dirty_ids(self):
+        return set(Step._base_manager.filter(is_dirty=True).values_list('id', flat=True))
+
+    def test_created_on_a_step(self):
+        Subscriber.objects.create(email='a@example.com', step=self.first)
+        self.assertEqual(self.dirty_ids(), set([self.first.id]))
+
+    def test_moved_or_reactivated_with_save(self):
+        subscriber = Subscriber.objects.create(email='a@example.com', step=self.first)
+        self.mark_all_clean()
+        subscriber.email = 'b@example.com'
+        subscriber.save()
+        self.assertEqual(self.dirty_ids(), set())
+
+        subscriber.step = self.second
+        subscriber.save()
+        self.assertEqual(self.dirty_ids(), set([self.first.id, self.second.id]))
+
+        subscriber.unsubscribe()
+        self.mark_all_clean()
+        subscriber = Subscriber.objects.get(id=subscriber.id)
+        subscriber.is_active = True
+        subscriber.save()
+        self.assertEqual(self.dirty_ids(), set([self.second.id]))
+
+
+class RunnableStepTestCase(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        self.delay = Delay.objects.create(duration=timedelta(days=1))
+        self.delay_step = Step.objects.create(content_object=self.delay)
+        self.idle_step = Step.objects.create(description='idle')
+        Step._base_manager.update(is_dirty=False)
+
+    def runnable_ids(self, now=None):
+        return set(step.id for step in Step.objects.runnable(now=now or self.now))
+
+    def get_step(self, step):
+        return Step._base_manager.get(id=step.id)
+
+    def test_clean_idle_steps_are_not_runnable(self):
+        Subscriber.objects.create(email='a@example.com')
+        self.assertEqual(self.runnable_ids(), set())
+
+    def test_dirty_step(self):
+        self.assertEqual(Step.objects.mark_dirty([self.idle_step.id]), 1)
+        self.assertEqual(self.runnable_ids(), set([self.idle_step.id]))
+
+        self.idle_step.mark_clean()
+        self.assertEqual(self.runnable_ids(), set())
+
+    def test_inactive_dirty_step(self):
+        Step._base_manager.filter(id=self.idle_step.id).update(is_active=False)
+        Step.objects.mark_dirty([self.idle_step.id])
+        self.assertEqual(self.runnable_ids(), set())
+
+    def test_step_past_its_wake_at(self):
+        self.idle_step.wake_up_at(self.now + timedelta(hours=1))
+        self.assertEqual(self.runnable_ids(), set())
+        self.assertEqual(self.runnable_ids(now=self.now + timedelta(hours=1)), set([self.idle_step.id]))
+
+    def test_wake_up_at_only_moves_earlier(self):
+        self.assertEqual(self.idle_step.wake_up_at(None), 0)
+        self.assertIsNone(self.get_step(self.idle_step).wake_at)
+
+        self.assertEqual(self.idle_step.wake_up_at(self.now + timedelta(hours=1)), 1)
+        self.assertEqual(self.idle_step.wake_up_at(self.now + timedelta(hours=2)), 0)
+        self.assertEqual(self.get_step(self.idle_step).wake_at, self.now + timedelta(hours=1))
+
+        self.assertEqual(self.idle_step.wake_up_at(self.now - timedelta(minutes=1)), 1)
+        self.assertEqual(self.get_step(self.idle_step).wake_at, self.now - timedelta(minutes=1))
+
+    def test_mark_clean_clears_wake_at(self):
+        self.idle_step.wake_up_at(self.now - timedelta(minutes=1))
+        Step.objects.mark_dirty([self.idle_step.id])
+        self.idle_step.mark_clean()
+        step = self.get_step(self.idle_step)
+        self.assertFalse(step.is_dirty)
+        self.assertIsNone(step.wake_at)
+        self.assertEqual(self.runnable_ids(), set())
+
+    def test_delay_with_subscribers_past_due_at(self):
+        subscriber = Subscriber.objects.create(email='a@example.com')
+        Subscriber.objects.filter(id=subscriber.id).update(step=self.delay_step,
+                                                            due_at=self.now + timedelta(hours=1))
+        self.assertEqual(self.runnable_ids(), set())
+        self.assertEqual(self.runnable_ids(now=self.now + timedelta(hours=1)), set([self.delay_step.id]))
+
+        # only active subscribers count
+        Subscriber.objects.filter(id=subscriber.id).update(is_active=False)
+        self.assertEqual(self.runnable_ids(now=self.now + timedelta(hours=1)), set())
+
+    def test_due_at_on_a_step_that_isnt_a_delay(self):
+        subscriber = Subscriber.objects.create(email='a@example.com')
+        Subscriber.objects.filter(id=subscriber.id).update(step=self.idle_step,
+                                                            due_at=self.now - timedelta(hours=1))
+        self.assertEqual(self.runnable_ids(), set())
+
+
+class SubscriberMoveTestCase(TestCase):
+    def setUp(self):
+        self.step = Step.objects.create(description='first')
+        self.target = Step.objects.create(description='target')
+        self.subscribers = [Subscriber.objects.create(email='%i@example.com' % i, step=self.step) for i in range(3)]
+
+    def step_ids(self):
+        return dict(Subscriber.objects.values_list('email', 'step_id'))
+
+    def test_move_to_a_step_that_isnt_a_delay(self):
+        subscriber = self.subscribers[0]
+        # the save, and marking both steps dirty
+        with self.assertNumQueries(2):
+            subscriber.move_to_step(self.target)
+        subscriber = Subscriber.objects.get(id=subscriber.id)
+        self.assertEqual(subscriber.step_id, self.target.id)
+        self.assertIsNone(subscriber.due_at)
+
+    def test_move_to_a_delay_step(self):
+        delay_step = Step.objects.create(content_object=Delay.objects.create(duration=timedelta(hours=2)))
+        subscriber = self.subscribers[0]
+        with self.assertNumQueries(3):
+            subscriber.move_to_step(delay_step)
+        subscriber = Subscriber.objects.get(id=subscriber.id)
+        self.assertEqual(subscriber.due_at, subscriber.step_timestamp + timedelta(hours=2))
+        # given an id, the step is looked up too
+        with self.assertNumQueries(4):
+            self.subscribers[1].move_to_step(delay_step.id)
+
+    def test_subscribers_moved_is_sent_per_chunk(self):
+        received = []
+
+        def receiver(sender, step_id, subscriber_ids, timestamp, **kwargs):
+            received.append((step_id, list(subscriber_ids), timestamp))
+
+        subscribers_moved.connect(receiver, sender=Subscriber)
+        try:
+            ids = [subscriber.id for subscriber in self.subscribers]
+            moved = Subscriber.objects.move_ids_to_step(ids, self.target.id, chunk_size=2)
+        finally:
+            subscribers_moved.disconnect(receiver, sender=Subscriber)
+        self.assertEqual(moved, 3)
+        self.assertEqual([(step_id, subscriber_ids) for step_id, subscriber_ids, _ in received],
+                         [(self.target.id, ids[:2]), (self.target.id, ids[2:])])
+        self.assertEqual(received[0][2], received[1][2])
+
+    def test_modify_moves_with_the_queryset_method(self):
+        modify = Modify.objects.create(modify_type='move', content_object=self.target)
+        # step_move_many, rather than step_move per subscriber
+        with mock.patch.object(Subscriber, 'move_to_step') as move_to_step:
+            modify.step_run(self.step, self.step.subscribers.filter(is_active=True))
+        self.assertFalse(move_to_step.called)
+        self.assertEqual(set(self.step_ids().values()), set([self.target.id]))
+
+    def test_email_activity_moves_in_bulk(self):
+        activity = EmailActivity.objects.create(type='click', on_false=self.target)
+        with mock.patch.object(Subscriber, 'move_to_step') as move_to_step:
+            activity.step_run(self.step, self.step.subscribers.filter(is_active=True))
+        self.assertFalse(move_to_step.called)
+        moved = Subscriber.objects.filter(step=self.target)
+        self.assertEqual(moved.count(), 3)
+        self.assertEqual(moved.values('step_timestamp').distinct().count(), 1)
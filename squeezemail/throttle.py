@@ -0,0 +1,134 @@
+import logging
+import smtplib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from squeezemail import SQUEEZE_PREFIX, SQUEEZE_SEND_RATE_LIMIT, SQUEEZE_DOMAIN_RATE_LIMITS, SQUEEZE_THROTTLE_BACKOFF
+
+logger = logging.getLogger(__name__)
+
+# SMTP replies that mean 'slow down and try again later', not 'this message is bad'.
+TEMPORARY_SMTP_CODES = (421, 450, 451, 452)
+
+
+class RateLimiter(object):
+    """
+    A token bucket shared through Django's cache by every worker, refilled at rate tokens a second.
+    Each second's tokens are handed out as evenly spaced send times, so workers sending at the same time are spread out
+    across the second instead of all bursting at the top of it.
+    Needs a cache with atomic add/incr that every worker shares (memcached, redis).
+    """
+
+    def __init__(self, name, rate):
+        self.name = name
+        self.rate = rate
+        self.key = '%sthrottle-%s' % (SQUEEZE_PREFIX, name)
+
+    def acquire(self):
+        """
+        Blocks until this worker may send one email. Returns how many seconds it waited.
+        """
+        waited = 0.0
+        while True:
+            now = time.time()
+            backoff_until = cache.get('%s-backoff' % self.key)
+            if backoff_until and backoff_until > now:
+                waited += self.sleep(backoff_until - now)
+                continue
+
+            window = int(now)
+            window_key = '%s-%i' % (self.key, window)
+            cache.add(window_key, 0, 5)
+            try:
+                token = cache.incr(window_key)
+            except ValueError:  # expired between add and incr
+                continue
+
+            if token <= self.rate:
+                send_at = window + float(token - 1) / self.rate
+                if send_at > now:
+                    waited += self.sleep(send_at - now)
+                return waited
+            # this second is used up, wait for the next one
+            waited += self.sleep(window + 1 - now)
+
+    def back_off(self, seconds=None):
+        """
+        Pauses every worker sending through this limiter, e.g. after the server answered 421.
+        """
+        seconds = seconds or SQUEEZE_THROTTLE_BACKOFF
+        logger.warning("Backing off from %s for %i seconds.", self.name, seconds)
+        cache.set('%s-backoff' % self.key, time.time() + seconds, seconds + 1)
+
+    @staticmethod
+    def sleep(seconds):
+        time.sleep(seconds)
+        return seconds
+
+
+class SendThrottle(object):
+    """
+    The rate limits that apply to sending through one relay: SQUEEZE_SEND_RATE_LIMIT for the relay itself, and
+    SQUEEZE_DOMAIN_RATE_LIMITS for recipient domains. Either can be left unset.
+    """
+
+    def __init__(self, relay=None):
+        self.relay = relay or '%s:%s' % (settings.EMAIL_HOST, settings.EMAIL_PORT)
+        self.relay_limiter = RateLimiter('relay-%s' % self.relay, SQUEEZE_SEND_RATE_LIMIT) \
+            if SQUEEZE_SEND_RATE_LIMIT else None
+        self.domain_limiters = dict(
+            (domain.lower(), RateLimiter('domain-%s' % domain.lower(), rate))
+            for domain, rate in SQUEEZE_DOMAIN_RATE_LIMITS.items()
+        )
+
+    @classmethod
+    def for_backend_kwargs(cls, backend_kwargs=None):
+        backend_kwargs = backend_kwargs or {}
+        host = backend_kwargs.get('host') or settings.EMAIL_HOST
+        port = backend_kwargs.get('port') or settings.EMAIL_PORT
+        return cls('%s:%s' % (host, port))
+
+    @property
+    def enabled(self):
+        return bool(self.relay_limiter or self.domain_limiters)
+
+    @staticmethod
+    def get_domain(address):
+        return address.rstrip('>').rpartition('@')[2].lower()
+
+    def limiters_for(self, email_message):
+        limiters = [self.relay_limiter] if self.relay_limiter else []
+        if self.domain_limiters:
+            domains = set(self.get_domain(address) for address in email_message.recipients())
+            limiters.extend(self.domain_limiters[domain] for domain in domains if domain in self.domain_limiters)
+        return limiters
+
+    def wait(self, email_message):
+        """
+        Blocks until email_message may be sent without going over any of its limits.
+        """
+        waited = sum(limiter.acquire() for limiter in self.limiters_for(email_message))
+        if waited:
+            logger.debug("Throttled sending to %s for %.2f seconds.", email_message.to, waited)
+        return waited
+
+    @staticmethod
+    def is_temporary_failure(exception):
+        # aiosmtplib has its own SMTPServerDisconnected
+        return (isinstance(exception, smtplib.SMTPServerDisconnected) or
+                type(exception).__name__ == 'SMTPServerDisconnected' or
+                getattr(exception, 'smtp_code', None) in TEMPORARY_SMTP_CODES or
+                getattr(exception, 'code', None) in TEMPORARY_SMTP_CODES)
+
+    def back_off(self, email_message):
+        """
+        Called when the server refused email_message for now. Pauses every worker sending through the relay and the
+        message's limited domains for SQUEEZE_THROTTLE_BACKOFF seconds, or just this one if nothing is limited.
+        """
+        limiters = self.limiters_for(email_message)
+        for limiter in limiters:
+            limiter.back_off()
+        if not limiters:
+            time.sleep(SQUEEZE_THROTTLE_BACKOFF)